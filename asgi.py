@@ -0,0 +1,199 @@
+import os
+import json
+import asyncio
+import argparse
+from urllib.parse import parse_qs
+
+import generate_query_id as service
+from background_loop import use_loop
+from query_writer import close_query_writer
+from refresh_jobs import get_job
+from storage import init_db, get_database_path, get_latest_change_seq, ChangesPruned
+from change_feed import get_change_feed
+from work_leases import get_lease_manager
+from metrics import share_metrics
+
+# Production serving mode: the API of generate_query_id.py on an ASGI server.
+# The Flask app answers every route from a thread pool, so there is one implementation of the API.
+# Only the routes that wait run as coroutines on the server's event loop, the same loop the Telethon
+# clients, the batch writer and the scheduler run on: refreshes, the change long-poll and the job
+# event streams never hold a thread while they wait.
+#
+#   python asgi.py --workers 4
+#   uvicorn asgi:app --workers 4 --port 3000
+#
+# uvicorn and a2wsgi are optional dependencies, only needed for this mode: pip install uvicorn a2wsgi
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    print("Error: the production mode needs a2wsgi, install it with 'pip install a2wsgi'.")
+    exit(1)
+
+SSE_KEEP_ALIVE = 15  # Seconds between keep-alive comments on idle event streams
+WSGI_THREADS = 10  # Threads running the Flask handlers
+
+flask_app = WSGIMiddleware(service.app, workers=WSGI_THREADS)
+
+_leader_lock = None  # Lock file held by the worker process running the background refresh
+
+# With several worker processes only one of them refreshes in the background, the others only serve.
+# The lock file next to the database is held for the lifetime of that process.
+def _acquire_leadership() -> bool:
+    global _leader_lock
+    try:
+        import fcntl
+    except ImportError:
+        return True  # No flock on this platform, run a single worker here
+    lock = open(get_database_path() + '.leader', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _leader_lock = lock
+    return True
+
+async def _startup():
+    use_loop(asyncio.get_running_loop())  # run_coroutine/submit users share the server loop
+    service.load_settings()
+    await asyncio.to_thread(init_db)
+    share_metrics()  # /metrics of every worker process reports the sum over all of them
+    if _acquire_leadership():
+        job = await asyncio.to_thread(service.start_background_refresh)
+        print(f"Background refresh running in process {os.getpid()}, job {job.id}")
+
+async def _shutdown():
+    if service.scheduler is not None:
+        service.scheduler.stop()
+    await close_query_writer()
+    await asyncio.to_thread(get_lease_manager().release_all)  # Other instances may take over right away
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await _startup()
+            except (Exception, SystemExit) as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+# Same CORS headers flask_cors sends by default, the preflight requests are answered by the Flask app
+def _headers(content_type, extra=None):
+    headers = [(b'content-type', content_type.encode()), (b'access-control-allow-origin', b'*')]
+    for name, value in (extra or {}).items():
+        headers.append((name.lower().encode(), str(value).encode()))
+    return headers
+
+async def _respond(send, status, body=b'', content_type='application/json', headers=None):
+    await send({'type': 'http.response.start', 'status': status, 'headers': _headers(content_type, headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _respond_json(send, status, payload, headers=None):
+    await _respond(send, status, json.dumps(payload).encode(), 'application/json', headers)
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def refresh_queries(scope, receive, send, request_headers):
+    try:
+        data = json.loads(await _read_body(receive) or b'{}')
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        body, status = await service.refresh(data)
+    except service.ApiError as e:
+        return await _respond_json(send, e.status, {'error': e.message})
+    await _respond_json(send, status, body)
+
+async def get_query_changes(scope, receive, send, request_headers):
+    args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode()).items()}
+    try:
+        since, wait, limit = service.parse_change_args(args.get('since'), args.get('wait'), args.get('limit'))
+    except service.ApiError as e:
+        return await _respond_json(send, e.status, {'error': e.message})
+    if since is None:
+        return await _respond_json(send, 200, {'changes': [], 'next_since': await asyncio.to_thread(get_latest_change_seq)})
+    try:
+        changes = await get_change_feed().wait_async(since, wait, limit)
+    except ChangesPruned as e:
+        return await _respond_json(send, 410, {'error': str(e)})
+    await _respond_json(send, 200, service.changes_response(changes, since))
+
+# Server-Sent Events stream of every (session, bot) row of a job, see stream_refresh_job in generate_query_id.py
+async def stream_refresh_job(send, job, request_headers):
+    last_event_id = request_headers.get('last-event-id')
+    position = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': _headers(
+        'text/event-stream', {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})})
+    while True:
+        events, finished = await job.wait_events(position, SSE_KEEP_ALIVE)
+        position += len(events)
+        if events:
+            chunk = ''.join(f"id: {event['seq']}\nevent: row\ndata: {json.dumps(event)}\n\n" for event in events)
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        elif finished:
+            break
+        else:
+            await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+    await send({'type': 'http.response.body', 'body': f"event: end\ndata: {json.dumps(job.to_dict())}\n\n".encode()})
+
+# The routes that wait are served here, everything else by the Flask app
+async def _http(scope, receive, send):
+    method = scope['method']
+    path = scope['path'].rstrip('/') or '/'
+    request_headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+
+    if path == '/api/refreshAll/query' and method == 'POST':
+        return await refresh_queries(scope, receive, send, request_headers)
+    if path == '/api/changes' and method == 'GET':
+        return await get_query_changes(scope, receive, send, request_headers)
+    if path.startswith('/api/jobs/') and path.endswith('/events') and method == 'GET':
+        job = await asyncio.to_thread(get_job, path[len('/api/jobs/'):-len('/events')])
+        if job is None:
+            return await _respond_json(send, 404, {'error': 'Job not found'})
+        return await stream_refresh_job(send, job, request_headers)
+    await flask_app(scope, receive, send)
+
+# The ASGI application
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] == 'http':
+        try:
+            return await _http(scope, receive, send)
+        except Exception as e:
+            print(f"Error while handling {scope['method']} {scope['path']}: {e}")
+            return await _respond_json(send, 500, {'error': 'Internal server error'})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the API in production mode on an ASGI server")
+    parser.add_argument('--host', default='127.0.0.1', help="address to bind (default 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=3000, help="port to bind (default 3000)")
+    parser.add_argument('--workers', type=int, default=1, help="server processes (default 1)")
+    parser.add_argument('--keep-alive', type=int, default=30, help="seconds idle connections are kept open (default 30)")
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        print("Error: the production mode needs uvicorn, install it with 'pip install uvicorn'.")
+        exit(1)
+
+    print(f"head over to the site http://{args.host}:{args.port} to read the api docs")
+    uvicorn.run('asgi:app', host=args.host, port=args.port, workers=args.workers,
+                timeout_keep_alive=args.keep_alive, lifespan='on')
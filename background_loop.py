@@ -0,0 +1,57 @@
+import asyncio
+import threading
+
+# One asyncio event loop that lives in its own thread for the whole lifetime of the app.
+# Flask handlers submit coroutines to it instead of creating a new loop with asyncio.run,
+# so connections, caches and rate-limit state created on it survive across requests.
+_loop = None
+_thread = None
+_lock = threading.Lock()
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+# Start the background loop on first use and return it
+def get_loop():
+    global _loop, _thread
+
+    with _lock:
+        if _loop is None or _loop.is_closed() or (_thread is not None and not _thread.is_alive()):
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_run_loop, args=(_loop,), name="asyncio-loop", daemon=True)
+            _thread.start()
+        return _loop
+
+# Use a loop that is already running as the background loop, e.g. the loop of the ASGI server in asgi.py.
+# Everything that would run on the background loop then shares it with the request handlers.
+def use_loop(loop):
+    global _loop, _thread
+
+    with _lock:
+        _loop = loop
+        _thread = None  # The loop belongs to its owner, stop_loop leaves it alone
+
+# Schedule a coroutine on the background loop and return a concurrent.futures.Future
+def submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+# Run a coroutine on the background loop and block the calling thread until it is done
+def run_coroutine(coro, timeout=None):
+    loop = get_loop()
+    if loop.is_running() and _running_loop() is loop:
+        coro.close()
+        raise RuntimeError("run_coroutine would block the background loop itself, await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+# Stop the background loop, pending coroutines are abandoned
+def stop_loop():
+    with _lock:
+        if _loop is not None and _thread is not None and not _loop.is_closed():
+            _loop.call_soon_threadsafe(_loop.stop)
@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+from types import SimpleNamespace
+from urllib.parse import quote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Refresh throughput benchmark that never talks to Telegram.
+# TelegramClient is replaced by an in-process fake with configurable latency, error rate and
+# FloodWait injection, and every proxy is a local HTTP stand-in that also answers the proxy probe.
+#
+#   python benchmark.py --sessions 200 --bots 12 --latency 0.05
+
+# Answers every request with 200, both as a proxy and as the PROXY_CHECK_URL probe
+class ProbeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'{"origin": "127.0.0.1"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep the benchmark output readable
+
+def start_probe_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ProbeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class FakeSession:
+    def __init__(self, session: str):
+        self.session = session
+        self.proxy = None
+
+# Stands in for TelegramClient in query_pipeline, every call just sleeps for the latency
+class FakeTelegramClient:
+    latency = 0.05  # Seconds per round trip
+    error_rate = 0.0  # Share of web-view requests failing with an error
+    flood_rate = 0.0  # Share of web-view requests failing with a FloodWait
+    flood_seconds = 1  # Seconds of the injected FloodWaits
+    calls = 0
+    connects = 0
+    web_views = []  # (session, bot) of every web-view request
+    bot_ids = {}  # {peer id: bot username}
+
+    def __init__(self, session, api_id=None, api_hash=None):
+        self.session = FakeSession(session)
+        self.user_id = zlib.crc32(session.encode())
+
+    async def _round_trip(self):
+        FakeTelegramClient.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    async def connect(self):
+        FakeTelegramClient.connects += 1
+        await self._round_trip()
+
+    async def disconnect(self):
+        pass
+
+    async def get_me(self):
+        await self._round_trip()
+        return SimpleNamespace(id=self.user_id, first_name="Bench", last_name=str(self.user_id), username=f"bench{self.user_id}")
+
+    async def get_input_entity(self, username):
+        await self._round_trip()
+        FakeTelegramClient.bot_ids[zlib.crc32(username.encode())] = username
+        return SimpleNamespace(user_id=zlib.crc32(username.encode()), access_hash=42)
+
+    async def __call__(self, request):
+        from telethon.errors import FloodWaitError
+
+        await self._round_trip()
+        FakeTelegramClient.web_views.append((self.session.session, self.bot_ids.get(request.peer.user_id)))
+        roll = random.random()
+        if roll < self.flood_rate:
+            raise FloodWaitError(request=request, capture=self.flood_seconds)
+        if roll < self.flood_rate + self.error_rate:
+            raise RuntimeError("Injected error")
+
+        user = json.dumps({'id': self.user_id, 'first_name': 'Bench', 'username': f'bench{self.user_id}'})
+        data = f"query_id=AAF{random.getrandbits(64):x}&user={quote(user)}&auth_date={int(time.time())}&hash={random.getrandbits(128):032x}"
+        return SimpleNamespace(url=f"https://bench.invalid/#tgWebAppData={quote(data, safe='')}&tgWebAppVersion=7.10")
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def latency_summary(values):
+    return {'p50_ms': round(percentile(values, 0.50) * 1000, 2), 'p99_ms': round(percentile(values, 0.99) * 1000, 2)}
+
+# Scratch directory with N session files, proxy stand-ins listed in proxies.txt and a fresh database
+def create_workspace(work_dir, sessions, proxies):
+    os.chdir(work_dir)
+    os.makedirs('sessions')
+    for index in range(sessions):
+        with open(os.path.join('sessions', f'bench_{index:05d}.session'), 'w') as file:
+            file.write(f'bench-session-{index}')
+
+    probe_servers = [start_probe_server() for _ in range(max(proxies, 1))]
+    with open('proxies.txt', 'w') as file:
+        for server in probe_servers[:proxies]:
+            file.write(f"http://127.0.0.1:{server.server_address[1]}\n")
+    return probe_servers
+
+# Point the app at the workspace and swap the Telegram client for the fake, returns (module, bots)
+def install_fakes(settings):
+    os.chdir(settings['work_dir'])
+    sys.path.insert(0, settings['repo_dir'])
+    os.environ['DATABASE_PATH'] = os.path.join(settings['work_dir'], 'bench.db')
+    os.environ['PROXY_CHECK_URL'] = settings['check_url']
+
+    FakeTelegramClient.latency = settings['latency']
+    FakeTelegramClient.error_rate = settings['error_rate']
+    FakeTelegramClient.flood_rate = settings['flood_rate']
+    FakeTelegramClient.flood_seconds = settings['flood_seconds']
+
+    import query_pipeline as pipeline
+    import generate_query_id as app_module
+
+    pipeline.TelegramClient = FakeTelegramClient
+    pipeline.StringSession = lambda session: session
+    pipeline.api_id, pipeline.api_hash = 1, 'bench'
+    pipeline.max_concurrency = settings['concurrency']
+    pipeline.max_concurrency_per_proxy = settings['per_proxy']
+    bots = [f'bench_{index}_bot' for index in range(settings['bots'])]
+    pipeline.usernames = bots
+    return app_module, bots
+
+# One instance of --instances: a stale-only refresh of every session, like a restarted instance does
+def run_instance(settings):
+    app_module, bots = install_fakes(settings)
+    from query_writer import close_query_writer
+
+    async def refresh():
+        try:
+            await app_module.generate_queries_for_all_sessions(bots, max_age=3600)
+        finally:
+            await close_query_writer()
+
+    asyncio.run(refresh())
+    return FakeTelegramClient.web_views
+
+# Run several instances against the same database at once. The work leases should leave every
+# (session, bot) unit to a single instance, so the web-view requests match the units.
+def run_instances(app_module, settings):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from storage import get_connection
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=settings['instances'], mp_context=multiprocessing.get_context('spawn')) as executor:
+        web_views = [view for views in executor.map(run_instance, [settings] * settings['instances']) for view in views]
+    units = set(web_views)
+    return {
+        'instances': settings['instances'],
+        'seconds': round(time.perf_counter() - started, 3),
+        'web_views': len(web_views),
+        'units': len(units),
+        'duplicates': len(web_views) - len(units),
+        'rows': get_connection().execute('SELECT COUNT(*) FROM queries').fetchone()[0],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark query refreshes against a fake Telegram client")
+    parser.add_argument('--sessions', type=int, default=100, help="synthetic sessions (default 100)")
+    parser.add_argument('--bots', type=int, default=12, help="bots per session (default 12)")
+    parser.add_argument('--proxies', type=int, default=4, help="local proxy stand-ins, 0 connects directly (default 4)")
+    parser.add_argument('--concurrency', type=int, default=10, help="MAX_CONCURRENCY (default 10)")
+    parser.add_argument('--per-proxy', type=int, default=5, help="MAX_CONCURRENCY_PER_PROXY (default 5)")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per fake round trip (default 0.05)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of failing requests (default 0)")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="share of requests hitting a FloodWait (default 0)")
+    parser.add_argument('--flood-seconds', type=int, default=1, help="seconds of the injected FloodWaits (default 1)")
+    parser.add_argument('--requests', type=int, default=200, help="HTTP reads against the Flask app (default 200)")
+    parser.add_argument('--instances', type=int, default=1,
+                        help="run this many instances against one database and count duplicate work (default 1)")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    # Everything happens in a scratch directory with its own database, sessions and proxies
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='query_id_bench_')
+    probe_servers = create_workspace(work_dir, args.sessions, args.proxies)
+    settings = dict(vars(args), work_dir=work_dir, repo_dir=repo_dir,
+                    check_url=f"http://127.0.0.1:{probe_servers[0].server_address[1]}/ip")
+    app_module, bots = install_fakes(settings)
+
+    import storage
+    import query_writer
+    from background_loop import run_coroutine
+
+    if args.instances > 1:
+        storage.init_db()
+        report = run_instances(app_module, settings)
+        for server in probe_servers:
+            server.shutdown()
+        os.chdir(repo_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        print(json.dumps(report, indent=2) if args.json else
+              f"\n{args.instances} instances: {report['web_views']} web-view requests for {report['units']} (session, bot) units, "
+              f"{report['duplicates']} duplicates, {report['rows']} rows in {report['seconds']}s")
+        return
+
+    # Time every session and every database batch
+    session_latencies = []
+    import query_pipeline as pipeline
+    original_generate = pipeline.generate_queries_for_session
+
+    async def timed_generate(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original_generate(*args, **kwargs)
+        finally:
+            session_latencies.append(time.perf_counter() - started)
+
+    pipeline.generate_queries_for_session = timed_generate
+
+    db_stats = {'rows': 0, 'batches': 0, 'seconds': 0.0}
+    original_write_batch = query_writer.write_batch
+
+    def timed_write_batch(queries, sessions):
+        started = time.perf_counter()
+        original_write_batch(queries, sessions)
+        db_stats['seconds'] += time.perf_counter() - started
+        db_stats['rows'] += len(queries) + len(sessions)
+        db_stats['batches'] += 1
+
+    query_writer.write_batch = timed_write_batch
+
+    storage.init_db()
+    from rate_limiter import get_rate_limiter
+    report = {'sessions': args.sessions, 'bots': args.bots, 'proxies': args.proxies,
+              'concurrency': args.concurrency, 'latency': args.latency,
+              'account_rate_limit': get_rate_limiter().rate}  # The shipped default unless ACCOUNT_RATE_LIMIT is set
+
+    # Cold run: every account is identified and every bot resolved, warm run: both come from the caches
+    for label in ('cold', 'warm'):
+        session_latencies.clear()
+        FakeTelegramClient.calls = FakeTelegramClient.connects = 0
+        started = time.perf_counter()
+        results = run_coroutine(app_module.generate_queries_for_all_sessions(bots))
+        elapsed = time.perf_counter() - started
+
+        rows = sum(1 for outcome in results.values() if isinstance(outcome, dict)
+                   for result in outcome.values() if not isinstance(result, BaseException))
+        report[f'{label}_refresh'] = {
+            'seconds': round(elapsed, 3),
+            'rows': rows,
+            'rows_per_second': round(rows / elapsed, 1) if elapsed else 0,
+            'connects': FakeTelegramClient.connects,
+            'telegram_calls': FakeTelegramClient.calls,
+            'session_latency': latency_summary(session_latencies),
+        }
+
+    report['db_writes'] = {
+        'rows': db_stats['rows'],
+        'batches': db_stats['batches'],
+        'rows_per_second': round(db_stats['rows'] / db_stats['seconds'], 1) if db_stats['seconds'] else 0,
+    }
+
+    # Reads through the Flask app: full responses, conditional polls and pages
+    client = app_module.app.test_client()
+    for label, expected_status, make_request in (
+        ('get_all', 200, lambda etag: client.get('/api/getAll/query')),
+        ('get_all_304', 304, lambda etag: client.get('/api/getAll/query', headers={'If-None-Match': etag})),
+        ('get_page', 200, lambda etag: client.get('/api/getAll/query?limit=100')),
+        ('get_bot', 200, lambda etag: client.get(f'/api/getAll/query?bot={bots[0]}')),
+    ):
+        etag = client.get('/api/getAll/query?limit=1').headers.get('ETag')
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            request_started = time.perf_counter()
+            response = make_request(etag)
+            latencies.append(time.perf_counter() - request_started)
+            if response.status_code != expected_status:
+                raise AssertionError(f"{label}: expected status {expected_status}, got {response.status_code}")
+        elapsed = time.perf_counter() - started
+        report[label] = dict(latency_summary(latencies), requests_per_second=round(args.requests / elapsed, 1) if elapsed else 0)
+
+    # A full refresh through the API as a background job
+    started = time.perf_counter()
+    job = client.post('/api/refreshAll/query', json={}).get_json()
+    status = {}
+    while status.get('status') not in ('finished', 'failed'):
+        time.sleep(0.05)
+        status = client.get(f"/api/jobs/{job['job_id']}").get_json()
+    report['api_refresh_job'] = {'seconds': round(time.perf_counter() - started, 3),
+                                 'done': status['done'], 'failed': status['failed']}
+
+    run_coroutine(query_writer.close_query_writer())
+    for server in probe_servers:
+        server.shutdown()
+    os.chdir(repo_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print()
+    print(f"Benchmark: {args.sessions} sessions x {args.bots} bots, {args.proxies} proxies, "
+          f"concurrency {args.concurrency}, latency {args.latency * 1000:.0f} ms, "
+          f"account rate limit {report['account_rate_limit'] or 'off'}")
+    for label in ('cold_refresh', 'warm_refresh'):
+        run = report[label]
+        print(f"{label:>16}: {run['rows']} rows in {run['seconds']}s = {run['rows_per_second']} rows/s, "
+              f"{run['connects']} connects, {run['telegram_calls']} calls, "
+              f"session p50 {run['session_latency']['p50_ms']} ms / p99 {run['session_latency']['p99_ms']} ms")
+    print(f"{'db_writes':>16}: {report['db_writes']['rows']} rows in {report['db_writes']['batches']} batches "
+          f"= {report['db_writes']['rows_per_second']} rows/s")
+    for label in ('get_all', 'get_all_304', 'get_page', 'get_bot'):
+        run = report[label]
+        print(f"{label:>16}: {run['requests_per_second']} req/s, p50 {run['p50_ms']} ms / p99 {run['p99_ms']} ms")
+    print(f"{'api_refresh_job':>16}: {report['api_refresh_job']['done']} done, "
+          f"{report['api_refresh_job']['failed']} failed in {report['api_refresh_job']['seconds']}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import time
+import asyncio
+import threading
+from storage import get_changes, add_change_listener
+from settings import env_number
+
+DEFAULT_CHECK_INTERVAL = 1.0  # Seconds between database checks while long-polling, catches writes of other processes
+MAX_WAIT = 60  # Seconds a long-poll may wait at most
+
+# Long-polling on the change log. Writes of this process wake the waiting consumers right after their
+# commit (see storage.add_change_listener), writes of other processes are picked up by a periodic check.
+class ChangeFeed:
+    def __init__(self):
+        self.check_interval = env_number('CHANGE_FEED_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)
+        self.notifications = 0  # Bumped on every local write
+        self._cond = threading.Condition()
+        self._async_waiters = set()  # (loop, asyncio.Event) of the coroutines waiting right now
+
+    # Called from whichever thread committed the write, the events are set on their own loop
+    def notify(self):
+        with self._cond:
+            self.notifications += 1
+            self._cond.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # The loop was closed in the meantime
+
+    # Return the entries after since, waiting up to timeout seconds for the first one, from a Flask thread
+    def wait(self, since: int, timeout: float = 0, limit: int = 1000):
+        deadline = time.monotonic() + min(timeout, MAX_WAIT)
+        while True:
+            seen = self.notifications
+            changes = get_changes(since, limit)
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                return changes
+            with self._cond:
+                if self.notifications == seen:
+                    self._cond.wait(min(remaining, self.check_interval))
+
+    # Same from a coroutine on the event loop, the database reads run off the loop.
+    # The waiter is registered before the read, so a write committed during the read still wakes it.
+    async def wait_async(self, since: int, timeout: float = 0, limit: int = 1000):
+        deadline = time.monotonic() + min(timeout, MAX_WAIT)
+        loop = asyncio.get_running_loop()
+        while True:
+            waiter = (loop, asyncio.Event())
+            with self._cond:
+                self._async_waiters.add(waiter)
+            try:
+                changes = await asyncio.to_thread(get_changes, since, limit)
+                remaining = deadline - time.monotonic()
+                if changes or remaining <= 0:
+                    return changes
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), min(remaining, self.check_interval))
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                with self._cond:
+                    self._async_waiters.discard(waiter)
+
+_feed = None
+_feed_lock = threading.Lock()
+
+# Return the change feed of this process, registering it for the change notifications on first use
+def get_change_feed():
+    global _feed
+    with _feed_lock:
+        if _feed is None:
+            _feed = ChangeFeed()
+            add_change_listener(_feed.notify)
+        return _feed
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+
+# Headless batch mode: generate the queries of every session and write them to one file per bot,
+# without the web server. Nothing but the standard library is loaded until the arguments are parsed,
+# Telethon comes in with query_pipeline and requests/better_proxy only once a proxy is checked.
+#
+#   python cli.py --bots bot1,bot2 --output exports
+#   python cli.py --max-age 3600 --format jsonl   # cron: only the missing and stale queries
+#
+# The queries are also written to the database as usual, so a running API serves them too.
+# With --max-age the queries that were still fresh are added from the database at the end, so every file
+# holds the query of every account either way.
+
+# Writes every query to <output>/<bot>.txt (one query per line) or <output>/<bot>.jsonl as soon as it
+# is generated. Passed as the progress of generate_queries_for_all_sessions, like a RefreshJob.
+class QueryExporter:
+    def __init__(self, output_dir: str, bot_usernames, output_format: str = 'lines', max_age=None):
+        self.output_dir = output_dir
+        self.bot_usernames = list(bot_usernames)
+        self.output_format = output_format
+        # Taken before the run decides which queries are stale, so every query it leaves alone counts as fresh here
+        self.fresh_after = time.time() - max_age if max_age is not None else None
+        self.total = None
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0  # Left to another instance sharing the database
+        self.kept = 0  # Still fresh, written from the database
+        self.exported = {bot_username: set() for bot_username in self.bot_usernames}  # user_ids written per bot
+        self.files = {}
+
+    def path(self, bot_username: str) -> str:
+        extension = 'jsonl' if self.output_format == 'jsonl' else 'txt'
+        return os.path.join(self.output_dir, f"{bot_username}.{extension}")
+
+    # Every bot gets its file, so a bot without any query leaves an empty one instead of last run's
+    def start(self, total: int):
+        self.total = total
+        os.makedirs(self.output_dir, exist_ok=True)
+        for bot_username in self.bot_usernames:
+            if bot_username not in self.files:
+                self.files[bot_username] = open(self.path(bot_username), 'w', encoding='utf-8')
+        print(f"{total} queries to generate")
+
+    def record(self, session_file: str, bot_username: str, user_id=None, query=None, error=None):
+        from work_leases import WorkLeased  # Loaded by query_pipeline already
+
+        if error is not None:
+            if isinstance(error, WorkLeased):
+                self.skipped += 1
+            else:
+                self.failed += 1
+            return
+
+        self.write(session_file, bot_username, user_id, query)
+        self.done += 1
+
+    def write(self, session_file: str, bot_username: str, user_id, query: str):
+        if self.output_format == 'jsonl':
+            line = json.dumps({'session': session_file, 'user_id': user_id, 'bot_username': bot_username, 'query': query})
+        else:
+            line = query
+        file = self.files[bot_username]
+        file.write(line + '\n')
+        file.flush()  # Readers tailing the file see every query right away
+        self.exported[bot_username].add(user_id)
+
+    # With --max-age: add the queries of the accounts this run didn't write that were still fresh when it started,
+    # once the new queries are committed. A stale query whose refresh failed is left out, like in a full run.
+    def write_stored(self):
+        from storage import get_queries, get_registered_sessions
+
+        session_files = {row['user_id']: os.path.basename(row['path']) for row in get_registered_sessions()}
+        for bot_username in self.bot_usernames:
+            for row in get_queries(bot_username=bot_username):
+                if row['user_id'] in self.exported[bot_username]:
+                    continue
+                if row['auth_date'] is None or row['auth_date'] < self.fresh_after:
+                    continue
+                self.write(session_files.get(row['user_id']), bot_username, row['user_id'], row['query'])
+                self.kept += 1
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+async def run_batch(bot_usernames, exporter: QueryExporter, session_folder: str, max_age=None):
+    from query_pipeline import generate_queries_for_all_sessions
+    from query_writer import close_query_writer
+    from work_leases import get_lease_manager
+
+    try:
+        await generate_queries_for_all_sessions(bot_usernames, progress=exporter, max_age=max_age,
+                                                session_folder=session_folder)
+    finally:
+        await close_query_writer()  # Commit the queued rows before the loop goes away
+        await asyncio.to_thread(get_lease_manager().release_all)
+    if max_age is not None:
+        await asyncio.to_thread(exporter.write_stored)  # The queries this run left alone, or another instance refreshed
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate query IDs in batch mode and write them to one file per bot")
+    parser.add_argument('--bots', help="comma separated bot usernames (default BOT_USERNAMES from .env)")
+    parser.add_argument('--sessions', default='sessions', help="folder with the session files (default sessions)")
+    parser.add_argument('--concurrency', type=int, help="sessions processed at the same time (default MAX_CONCURRENCY)")
+    parser.add_argument('--per-proxy', type=int,
+                        help="sessions sharing one proxy processed at the same time (default MAX_CONCURRENCY_PER_PROXY)")
+    parser.add_argument('--output', default='exports', help="folder the files are written to (default exports)")
+    parser.add_argument('--format', choices=('lines', 'jsonl'), default='lines',
+                        help="lines writes one query per line to <bot>.txt, jsonl one JSON object per line to <bot>.jsonl")
+    parser.add_argument('--max-age', type=int,
+                        help="only generate the queries missing or older than this many seconds (default all)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.sessions):
+        print(f"Error: '{args.sessions}' folder not found.")
+        exit(1)
+    if args.max_age is not None and args.max_age < 0:
+        print("Error: --max-age must be a number of seconds.")
+        exit(1)
+
+    # The flags take precedence over the .env file, load_dotenv keeps variables that are already set
+    if args.bots is not None:
+        os.environ['BOT_USERNAMES'] = args.bots
+    if args.concurrency is not None:
+        os.environ['MAX_CONCURRENCY'] = str(args.concurrency)
+    if args.per_proxy is not None:
+        os.environ['MAX_CONCURRENCY_PER_PROXY'] = str(args.per_proxy)
+
+    import query_pipeline as pipeline
+    from storage import init_db
+
+    pipeline.load_settings()
+    init_db()
+
+    exporter = QueryExporter(args.output, pipeline.usernames, args.format, args.max_age)
+    started = time.time()
+    try:
+        asyncio.run(run_batch(pipeline.usernames, exporter, args.sessions, args.max_age))
+    except KeyboardInterrupt:
+        print("Process interrupted by user.")
+    finally:
+        exporter.close()
+
+    print(f"{exporter.done} queries written to {args.output} in {time.time() - started:.1f}s, "
+          f"{exporter.kept} still fresh, {exporter.failed} failed, {exporter.skipped} left to other instances")
+    if exporter.failed:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,462 +1,392 @@
 import os
-import re
-import sqlite3
 import asyncio
 import signal
-import random
-import requests
-from flask import Flask, jsonify, request, render_template
+import threading
+import argparse
+import json
+from flask import Flask, Response, jsonify, request, render_template, stream_with_context
 from flask_cors import CORS
-from urllib.parse import unquote
-from telethon import TelegramClient
-from telethon.errors import FloodWaitError
-from telethon.types import InputBotAppShortName
-from telethon.sessions import StringSession
-from telethon import functions
-from dotenv import load_dotenv, find_dotenv
-from better_proxy import Proxy
+import query_pipeline as pipeline
+from query_pipeline import (
+    load_settings, session_identity, generate_query, generate_queries_with_retries, generate_queries_for_all_sessions,
+    run_sharded_refresh
+)
+from background_loop import get_loop, run_coroutine, submit, stop_loop
+from query_writer import close_query_writer
+from refresh_jobs import create_job, get_job
+from refresh_scheduler import RefreshScheduler, get_saved_status as get_saved_scheduler_status
+from storage import (
+    init_db, get_queries as fetch_queries, get_session_for_user,
+    get_latest_change_seq, ChangesPruned
+)
+from query_cache import get_query_cache
+from change_feed import get_change_feed, MAX_WAIT
+from work_leases import WorkLeased, get_lease_manager
+from metrics import render_metrics
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS
 
-# Global variables
-api_id = None
-api_hash = None
-usernames = []
-flag_for_proxy_db= False
+# Global variables, the settings read by load_settings live in query_pipeline.py
+scheduler = None  # Background scheduler keeping the queries warm, see refresh_scheduler.py
 
 # Graceful exit on Ctrl+C
 def signal_handler(signal, frame):
     print("Exiting gracefully...")
-    asyncio.get_event_loop().stop()
-
-# Register the signal handler for Ctrl+C (SIGINT)
-signal.signal(signal.SIGINT, signal_handler)
-
-# Connect to the database
-def get_db_connection():
-    conn = sqlite3.connect('queries.db')
-    conn.row_factory = sqlite3.Row  # To return rows as dictionaries
-    return conn
-
-# Connect to the database
-def get_db_connection_for_sessions():
-    conn = sqlite3.connect('queries_for_sessions.db')
-    conn.row_factory = sqlite3.Row  # To return rows as dictionaries
-    return conn
-
-# Connect to the database
-def get_db_connection_for_proxy():
-    conn = sqlite3.connect('proxies.db')
-    conn.row_factory = sqlite3.Row  # To return rows as dictionaries
-    return conn
-
-# Create the queries table if it doesn't exist
-def init_db():
-    with get_db_connection() as db:
-        db.execute('DROP TABLE IF EXISTS queries')  # Drop the table if it exists
-        db.execute('''CREATE TABLE IF NOT EXISTS queries (
-            user_id INTEGER NOT NULL,
-            bot_username TEXT NOT NULL,
-            query TEXT NOT NULL,
-            name TEXT NOT NULL,
-            proxy TEXT
-        )''')
-
-# Create the queries table if it doesn't exist
-def init_db2():
-    with get_db_connection_for_sessions() as db2:
-        db2.execute('DROP TABLE IF EXISTS queries_for_sessions')  # Drop the table if it exists
-        db2.execute('''CREATE TABLE IF NOT EXISTS queries_for_sessions (
-            user_id INTEGER NOT NULL,
-            session_string TEXT NOT NULL
-        )''')
-
-# Create the queries table if it doesn't exist
-def init_db3():
-    with get_db_connection_for_proxy() as db3:
-        db3.execute('DROP TABLE IF EXISTS proxies')  # Drop the table if it exists
-        db3.execute('''CREATE TABLE IF NOT EXISTS proxies (
-            session_string TEXT NOT NULL PRIMARY KEY,
-            proxy TEXT
-        )''')
-
-# Clear the queries table
-def clear_queries():
-    with get_db_connection() as db:
-        db.execute('DELETE FROM queries')
-        db.commit()
-
-def clear_queries_for_specific(bot_name):
-    with get_db_connection() as db:
-        db.execute('DELETE FROM queries WHERE bot_username = ?', (bot_name,))
-        db.commit()
-
-def clear_queries_for_specific_user(user_id):
-    with get_db_connection() as db:
-        db.execute('DELETE FROM queries WHERE user_id = ?', (user_id,))
-        db.commit()
-
-def clear_queries_for_specific_user_and_botname(user_id, bot_name):
-    with get_db_connection() as db:
-        db.execute('DELETE FROM queries WHERE user_id = ? AND bot_username = ?', (user_id, bot_name))
-        db.commit()
-
-# Insert a new query into the database
-def insert_query(user_id: int, bot_username: str, query: str, name: str, proxy: str):
-    with get_db_connection() as db:
-        db.execute('INSERT INTO queries (user_id, bot_username, query, name, proxy) VALUES (?, ?, ?, ?, ?)',
-                   (user_id, bot_username, query, name, proxy))
-        db.commit()  # Save changes
-
-# Insert a new query into the database
-def insert_query_for_sessions(user_id: int, sessions: str):
-    with get_db_connection_for_sessions() as db2:
-        db2.execute('INSERT INTO queries_for_sessions (user_id, session_string) VALUES (?, ?)',
-                   (user_id, sessions))
-        db2.commit()  # Save changes
-# Insert a new query into the database
-def insert_query_for_proxy(proxy: str, sessions: str):
-    with get_db_connection_for_proxy() as db3:
-        db3.execute('INSERT INTO proxies (session_string, proxy) VALUES (?, ?)',
-                   (sessions, proxy))
-        db3.commit()  # Save changes
-
-def check_whether_userid_present_or_not(userid):
-    with get_db_connection_for_sessions() as db2:
-        # Query to check if the user ID exists in the 'queries_for_sessions' table
-        result = db2.execute('SELECT COUNT(*) FROM queries_for_sessions WHERE user_id = ?', (userid,)).fetchone()
-        return result[0] > 0  # Returns True if userid exists, otherwise False
-
-def check_whether_botname_present_or_not(bot):
-    with get_db_connection() as db:
-        # Query to check if the bot name exists in the 'queries' table
-        result = db.execute('SELECT COUNT(*) FROM queries WHERE bot_username = ?', (bot,)).fetchone()
-        return result[0] > 0  # Returns True if userid exists, otherwise False
+    shutdown()
+    raise KeyboardInterrupt
+
+# Write the queued rows, then stop the background event loop
+def shutdown():
+    try:
+        run_coroutine(close_query_writer(), timeout=30)
+    except Exception as e:
+        print(f"Error while flushing pending queries: {e}")
+    try:
+        get_lease_manager().release_all()  # Other instances may take over right away
+    except Exception as e:
+        print(f"Error while releasing the work leases: {e}")
+    stop_loop()
 
 # New route for the root URL
 @app.route('/')
 def index():
     return render_template('index.html')  # Render the index.html file
 
+# Error answered with its status code and {'error': message}, raised by the helpers shared with asgi.py
+class ApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+# Look up the queries of a GET /api/getAll/query request, shared by the Flask app and asgi.py.
+# Returns (etag, queries, next_cursor), next_cursor is only part of the response when a limit is set.
+def lookup_queries(userid=None, bot_name=None, limit=None, cursor=None):
+    cache = get_query_cache()  # Lookups are served from memory, see query_cache.py
+
+    # Case 1: Only 'userid' is provided
+    if userid and not bot_name:
+        if not cache.has_user(userid):
+            raise ApiError(404, 'User ID not found')
+    
+    # Case 2: Only 'bot' is provided
+    elif bot_name and not userid:
+        if not cache.has_bot(bot_name):
+            raise ApiError(404, 'Bot Name not found')
+    
+    # Case 3: Both 'userid' and 'bot' are provided
+    elif userid and bot_name:
+        if not cache.has_user(userid):
+            raise ApiError(404, 'User ID not found')
+        if not cache.has_bot(bot_name):
+            raise ApiError(404, 'Bot Name not found')
+    
+    # Case 4: Neither 'userid' nor 'bot' is provided, all queries are fetched
+
+    # Optional cursor based pagination: ?limit=[n]&cursor=[next_cursor of the previous page]
+    try:
+        limit = int(limit) if limit else None
+        if limit is not None and limit < 1:
+            raise ValueError
+    except ValueError:
+        raise ApiError(400, 'limit must be a positive integer')
+    try:
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        raise ApiError(400, 'cursor must be an integer')
+
+    etag = f'"q{cache.get_version()}"'
+    rowids, queries = cache.get(userid, bot_name, after=cursor, limit=limit)
+    return etag, queries, (rowids[-1] if rowids else cursor)
+
 @app.route('/api/getAll/query', methods=['GET'])
 def get_queries():
     # Get 'userid' and 'bot' parameters from the query string if provided
-    userid = request.args.get('userid')
-    bot_name = request.args.get('bot')
-
-    with get_db_connection() as db:
-        # Case 1: Only 'userid' is provided
-        if userid and not bot_name:
-            if not check_whether_userid_present_or_not(userid):
-                return jsonify({'error': 'User ID not found'}), 404  # Return a JSON response with a 404 error
-            queries = db.execute('SELECT * FROM queries WHERE user_id = ?', (userid,)).fetchall()
-        
-        # Case 2: Only 'bot' is provided
-        elif bot_name and not userid:
-            if not check_whether_botname_present_or_not(bot_name):
-                return jsonify({'error': 'Bot Name not found'}), 404  # Return a JSON response with a 404 error
-            queries = db.execute('SELECT * FROM queries WHERE bot_username = ?', (bot_name,)).fetchall()
-        
-        # Case 3: Both 'userid' and 'bot' are provided
-        elif userid and bot_name:
-            if not check_whether_userid_present_or_not(userid):
-                return jsonify({'error': 'User ID not found'}), 404  # Return a JSON response with a 404 error
-            if not check_whether_botname_present_or_not(bot_name):
-                return jsonify({'error': 'Bot Name not found'}), 404  # Return a JSON response with a 404 error
-            queries = db.execute('SELECT * FROM queries WHERE user_id = ? AND bot_username = ?', (userid, bot_name)).fetchall()
-        
-        # Case 4: Neither 'userid' nor 'bot' is provided
-        else:
-            # Fetch all queries if no userid is specified
-            queries = db.execute('SELECT * FROM queries').fetchall()
-        
-        # Convert the query result to a list of dictionaries and return as JSON
-        return jsonify({'queries': [dict(row) for row in queries]})
+    try:
+        etag, queries, next_cursor = lookup_queries(request.args.get('userid'), request.args.get('bot'),
+                                                    request.args.get('limit'), request.args.get('cursor'))
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status  # Return a JSON response with the error
+    paginated = bool(request.args.get('limit'))
+
+    # Unchanged table, unchanged response: answer polls with a 304 instead of the rows.
+    # Werkzeug keeps the tags without their quotes.
+    if request.if_none_match.contains(etag.strip('"')):
+        return Response(status=304, headers={'ETag': etag})
+
+    # NDJSON mode streams the rows one JSON object per line
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for query in queries:
+                yield json.dumps(query) + '\n'
+            if paginated:
+                yield json.dumps({'next_cursor': next_cursor}) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson', headers={'ETag': etag})
+
+    body = {'queries': queries}
+    if paginated:
+        body['next_cursor'] = next_cursor
+    response = jsonify(body)
+    response.headers['ETag'] = etag
+    return response
+
+# Parse the arguments of a GET /api/changes request, shared by the Flask app and asgi.py.
+# Returns (since, wait, limit), since is None when the consumer asks for the latest seq to start from.
+def parse_change_args(since=None, wait=None, limit=None):
+    try:
+        since = int(since) if since else None
+    except ValueError:
+        raise ApiError(400, 'since must be an integer')
+    try:
+        wait = min(float(wait), MAX_WAIT) if wait else 0
+        if wait < 0:
+            raise ValueError
+    except ValueError:
+        raise ApiError(400, 'wait must be a number of seconds')
+    try:
+        limit = min(int(limit), 10000) if limit else 1000
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        raise ApiError(400, 'limit must be a positive integer')
+    return since, wait, limit
 
-@app.route('/api/refreshAll/query', methods=['POST'])
-def refresh_queries():
-    global usernames
+# Body of a GET /api/changes response, next_since is the cursor of the next call
+def changes_response(changes, since):
+    return {'changes': [dict(row) for row in changes], 'next_since': changes[-1]['seq'] if changes else since}
 
-    # Get 'userid' and 'bot' from the JSON body
-    data = request.get_json()
+# Changes of the queries table after ?since=[seq], optionally waiting up to ?wait=[seconds] for the first one.
+# Without since only the latest seq is returned: load /api/getAll/query once, then follow the changes from there.
+@app.route('/api/changes', methods=['GET'])
+def get_query_changes():
+    try:
+        since, wait, limit = parse_change_args(request.args.get('since'), request.args.get('wait'), request.args.get('limit'))
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status  # Return a JSON response with the error
+    if since is None:
+        return jsonify({'changes': [], 'next_since': get_latest_change_seq()})
+    try:
+        changes = get_change_feed().wait(since, wait, limit)
+    except ChangesPruned as e:
+        return jsonify({'error': str(e)}), 410
+    return jsonify(changes_response(changes, since))
+
+# Run a POST /api/refreshAll/query request on the background loop, shared by the Flask app and asgi.py.
+# data is the JSON body, returns (response body, status code).
+async def refresh(data):
+    # Get 'userid' and 'bot' from the JSON body, an empty body refreshes everything
     userid = data.get('userid')
     bot_name = data.get('bot')
+
+    # Incremental refresh: only the queries missing or older than max_age seconds are regenerated
+    max_age = data.get('max_age')
+    if max_age is None and data.get('stale'):
+        max_age = pipeline.query_max_age
+    if max_age is not None and (not isinstance(max_age, (int, float)) or max_age < 0):
+        raise ApiError(400, 'max_age must be a number of seconds')
     
-    # Use a connection for session-specific queries
-    with get_db_connection_for_sessions() as db2:
-        # Case 1: Only 'userid' is provided
-        if userid and not bot_name:
-            if not check_whether_userid_present_or_not(userid):
-               return jsonify({'error': 'User ID not found'}), 404  # Return a JSON response with a 404 error
-            clear_queries_for_specific_user(userid)
-            # Fetch session_string values for the specified user_id
-            session_queries = db2.execute('SELECT session_string FROM queries_for_sessions WHERE user_id = ?', (userid,)).fetchall()
-            print("Generating query IDs for the following usernames:")
-            for username in usernames:
-                print(f"- {username}")
-                proxy_value= get_proxy(session_queries[0][0])
-                asyncio.run(generate_query(session_queries[0][0], username, proxy_value))
-
-            # Fetch updated queries for the specified user_id
-            with get_db_connection() as db:
-                queries = db.execute('SELECT * FROM queries WHERE user_id = ?', (userid,)).fetchall()
-        
-        # Case 2: Only 'bot' is provided
-        elif bot_name and not userid:
-            clear_queries_for_specific_bot(bot_name)  # Clear bot queries before inserting new ones
-            # Refresh the query for the specified bot
-            queries = refresh_query_for_bot(bot_name)
-        
-        # Case 3: Both 'userid' and 'bot' are provided
-        elif userid and bot_name:
-            if not check_whether_userid_present_or_not(userid):
-               return jsonify({'error': 'User ID not found'}), 404  # Return a JSON response with a 404 error
-            clear_queries_for_specific_user_and_botname(userid, bot_name)
-            session_queries = db2.execute('SELECT session_string FROM queries_for_sessions WHERE user_id = ?', (userid,)).fetchall()
-            print(f"Generating query IDs for the Bot {bot_name} of the user {userid}:")
-            proxy_value= get_proxy(session_queries[0][0])
-            asyncio.run(generate_query(session_queries[0][0], bot_name, proxy_value))
-            with get_db_connection() as db:
-                queries = db.execute('SELECT * FROM queries WHERE user_id = ? AND bot_username = ?', (userid, bot_name)).fetchall()
-        
-        # Case 4: Neither 'userid' nor 'bot' is provided
-        else:
-            clear_queries()  # Clear existing queries before inserting new ones
-            print("Generating new query IDs for the following usernames:")
+    # Case 1: Only 'userid' is provided
+    if userid and not bot_name:
+        if not await asyncio.to_thread(get_query_cache().has_user, userid):  # May catch the cache up, keep it off the loop
+           raise ApiError(404, 'User ID not found')
+        # The new queries replace the old ones row by row, clearing first could race with other instances
+        # Look up the session of the specified user_id in the registry
+        session = await asyncio.to_thread(get_session_for_user, userid)
+        print("Generating query IDs for the following usernames:")
+        for username in pipeline.usernames:
+            print(f"- {username}")
+        try:
+            await generate_queries_with_retries(session['session_string'], pipeline.usernames, flush=True,
+                                                identity=session_identity(session))
+        except Exception as e:
+            raise ApiError(502, str(e))  # The connection failed, answer with JSON instead of the HTML error page
+
+        # Fetch updated queries for the specified user_id
+        queries = await asyncio.to_thread(fetch_queries, user_id=userid)
     
-            # Generate new queries for all usernames
-            for username in usernames:
-                print(f"- {username}")
-                asyncio.run(generate_queries_for_all_sessions(username))
+    # Case 2: Only 'bot' is provided
+    elif bot_name and not userid:
+        # Refresh the query for the specified bot, the new queries replace the old ones row by row
+        try:
+            queries = (await refresh_query_for_bot(bot_name))['queries']
+        except Exception as e:
+            raise ApiError(502, str(e))
     
-            # Fetch all refreshed queries
-            with get_db_connection() as db:
-                queries = db.execute('SELECT * FROM queries').fetchall()
-                print("Database accessed: queries refreshed")  # Log to console
-
-    # Convert the query results to a list of dictionaries and return as JSON
-    return jsonify({'queries': [dict(row) for row in queries]})
-
-def refresh_query_for_bot(bot_name):
-    print(f"Refreshing query for bot: {bot_name}")
-    clear_queries_for_specific(bot_name)  # Clear bot queries before inserting new ones
-    print(f"Generating new query IDs for the {bot_name} bot:")
-    asyncio.run(generate_queries_for_all_sessions(bot_name))
+    # Case 3: Both 'userid' and 'bot' are provided
+    elif userid and bot_name:
+        if not await asyncio.to_thread(get_query_cache().has_user, userid):  # May catch the cache up, keep it off the loop
+           raise ApiError(404, 'User ID not found')
+        session = await asyncio.to_thread(get_session_for_user, userid)
+        print(f"Generating query IDs for the Bot {bot_name} of the user {userid}:")
+        try:
+            await generate_query(session['session_string'], bot_name, identity=session_identity(session))
+        except WorkLeased as e:
+            raise ApiError(409, str(e))
+        except Exception as e:
+            raise ApiError(502, str(e))  # The bot failed, e.g. after too many FloodWaits
+        queries = await asyncio.to_thread(fetch_queries, userid, bot_name)
     
-    # Fetch and return the updated queries
-    with get_db_connection() as db:
-        queries = db.execute('SELECT * FROM queries WHERE bot_username = ?', (bot_name,)).fetchall()
-        print("Database accessed: queries refreshed")  # Log to console on each access
-        return {'queries': [dict(row) for row in queries]}  # Return the queries in the expected format
-
-def validate_proxy(proxy_str: str) -> bool:
-    try:
-        # Parse the proxy using better_proxy
-        proxy = Proxy.from_str(proxy_str)
-        
-        # Set up the requests proxy dictionary
-        proxy_dict = {
-            "http": f"{proxy.protocol}://{proxy.login}:{proxy.password}@{proxy.host}:{proxy.port}",
-            "https": f"{proxy.protocol}://{proxy.login}:{proxy.password}@{proxy.host}:{proxy.port}"
-        }
-        
-        # Test a request through the proxy
-        response = requests.get("https://httpbin.org/ip", proxies=proxy_dict, timeout=10)
-        
-        # Check if we got a successful response
-        if response.status_code == 200:
-            print("Proxy is working!")
-            return True
-        else:
-            print("Proxy failed with status code:", response.status_code)
-            return False
-
-    except requests.exceptions.ProxyError as pe:
-        print(f"Proxy connection error: {pe}")
-        return False
-    except requests.exceptions.Timeout:
-        print("Request timed out while trying to connect through the proxy.")
-        return False
-    except Exception as e:
-        print(f"Proxy validation failed: {e}")
-        return False
-
-# Function to generate query ID for a single session string
-async def generate_query(session: str, bot_username: str, proxy=None):
-    global api_id, api_hash  # Access the global variables
-
-    if proxy is not None and not validate_proxy(proxy):
-       print(f"Proxy is dead {proxy}")
-       exit(1)
-
-    # Check and parse the proxy if provided
-    if proxy:
-        proxy = Proxy.from_str(proxy)  # Parse the proxy string
-        proxy_string = str(proxy)
-        proxy_dict = dict(
-            proxy_type=proxy.protocol,
-            addr=proxy.host,
-            port=proxy.port,
-            username=proxy.login,
-            password=proxy.password
-        )
+    # Case 4: Neither 'userid' nor 'bot' is provided, this runs as a background job
     else:
-        proxy_dict= None
-        proxy_string = None
+        # Nothing is cleared first: the old rows keep being served until their new query replaces them,
+        # also the rows of units another instance is generating
+        if max_age is None:
+            print("Generating new query IDs for the following usernames:")
+        else:
+            print(f"Refreshing query IDs older than {max_age} seconds for the following usernames:")
+        for username in pipeline.usernames:
+            print(f"- {username}")
+
+        job = await asyncio.to_thread(create_job, pipeline.usernames, max_age)
+        asyncio.ensure_future(run_refresh_job(job))
+        return {
+            'job_id': job.id,
+            'status_url': f'/api/jobs/{job.id}',
+            'events_url': f'/api/jobs/{job.id}/events',
+        }, 202
 
-    client = TelegramClient(StringSession(session), api_id, api_hash)
-    if proxy_dict:
-        client.session.proxy = proxy_dict
-        print(f"Using proxy: {proxy}")
-    else:
-        print("No proxy is beign used")
+    # Convert the query results to a list of dictionaries and return as JSON
+    return {'queries': [dict(row) for row in queries]}, 200
 
+@app.route('/api/refreshAll/query', methods=['POST'])
+def refresh_queries():
     try:
-        await client.connect()
-        me = await client.get_me()
-        name = me.first_name + " " + (me.last_name if me.last_name else "")
-        user_id = me.id
-        insert_query_for_sessions(user_id, session)  # Insert the query into the database
-
-        # Request the web app view
-        webapp_response = await client(functions.messages.RequestAppWebViewRequest(
-            peer=bot_username,
-            app=InputBotAppShortName(bot_id=await client.get_input_entity(bot_username), short_name="app"),
-            platform="ios",
-            write_allowed=True,
-            start_param="6094625904"
-        ))
-
-        # Parse query data from the URL
-        query = unquote(webapp_response.url.split("tgWebAppData=")[1].split("&")[0])
-        print(f"Successfully Query ID generated for user {name} | Bot: {bot_username} | username: {me.username}")
-        print()
-        insert_query(user_id, bot_username, query, name, proxy_string)  # Insert the query into the database
-
-        await client.disconnect()
-
-    except FloodWaitError as e:
-        wait_time = e.seconds + random.uniform(10, 30)  # Add a small random jitter to avoid precise retry timings
-        print(f"Rate limit encountered. Waiting for {e.seconds} seconds...")
-        await asyncio.sleep(wait_time)  # Wait for the required time
-        return await generate_query(session, bot_username, proxy_string)  # Retry after waiting
+        body, status = run_coroutine(refresh(request.get_json(silent=True) or {}))
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status  # Return a JSON response with the error
+    return jsonify(body), status
 
+# Generate new queries for all usernames in the background, one connection per session
+async def run_refresh_job(job):
+    try:
+        await generate_queries_for_all_sessions(job.bot_usernames, progress=job, max_age=job.max_age)
     except Exception as e:
-        await client.disconnect()
-        print(f"Error while generating query: {e}")
-        exit(1)
-
-# Function to load session strings from the 'sessions' folder and generate queries
-async def generate_queries_for_all_sessions(bot_username: str):
-    global flag_for_proxy_db
-
-    session_folder = 'sessions'
-
-    if not flag_for_proxy_db:
-        proxies = load_proxies("proxies.txt")
-        num_proxies = len(proxies)
-
-    if not os.path.exists(session_folder):
-        print(f"Error: '{session_folder}' folder not found.")
+        print(f"Refresh job {job.id} failed: {e}")
+        job.finish(e)
         return
+    print("Database accessed: queries refreshed")  # Log to console
+    job.finish()
 
-    for i, session_file in enumerate(os.listdir(session_folder)):
-        if session_file.endswith('.session'):
-            session_path = os.path.join(session_folder, session_file)
-            print(f"\nProcessing session file: {session_file}")
-
-            with open(session_path, 'r') as file:
-                session_string = file.read().strip()
-                
-
-                if not flag_for_proxy_db:
-                    # Use the proxy based on the index of the current session
-                    if i < num_proxies:
-                        proxy = proxies[i]  # Use the corresponding proxy
-                    else:
-                        proxy = None  # No more proxies available
-                    insert_query_for_proxy(proxy, session_string)
-
-            proxy_value= get_proxy(session_string)
-            await generate_query(session_string, bot_username, proxy_value)
-
-    flag_for_proxy_db = True
-
-def get_proxy(session: str):
-    with get_db_connection_for_proxy() as db3:
-        queries = db3.execute('SELECT proxy FROM proxies WHERE session_string = ?', (session,)).fetchall()
-        # Return the proxy if found, otherwise return None
-        if queries:
-            return queries[0][0]
-        else:
-            print("Session string not found in our database")
-            exit(1)
-
-def load_proxies(file_path):
-    # Validate the existence of the file
-    if not os.path.exists(file_path):
-        print(f"Error: The file '{file_path}' does not exist.")
-        exit(1)
+# Refresh the stale queries left from the last run, then let the scheduler keep them warm
+async def run_startup_refresh(job):
+    await run_refresh_job(job)
+    if scheduler is not None:
+        scheduler.start()
 
-    # Read the file and store proxies in a list
-    with open(file_path, 'r') as file:
-        proxies = [line.strip() for line in file if line.strip()]  # Strip whitespace and filter out empty lines
-
-    # Check if the file is empty
-    if not proxies:
-        print(f"Warning: The file '{file_path}' is empty.")
+# Same with the --workers processes, run from a thread so the API is up in the meantime
+def run_sharded_startup_refresh(bot_usernames, workers: int):
+    try:
+        run_sharded_refresh(bot_usernames, workers, max_age=pipeline.query_max_age)
+    except Exception as e:
+        print(f"Startup refresh failed: {e}")
+    if scheduler is not None:
+        get_loop().call_soon_threadsafe(scheduler.start)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_refresh_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+# Server-Sent Events stream of every (session, bot) row of a job as it completes
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_refresh_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    # Clients reconnecting with Last-Event-ID continue after the last event they saw
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    start = last_event_id + 1 if last_event_id is not None else 0
+
+    def generate():
+        for event in job.iter_events(start):
+            if event is None:
+                yield ': keep-alive\n\n'
+                continue
+            yield f"id: {event['seq']}\nevent: row\ndata: {json.dumps(event)}\n\n"
+        yield f"event: end\ndata: {json.dumps(job.to_dict())}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_status():
+    if scheduler is not None:
+        return jsonify(scheduler.to_dict())
+    # With asgi.py --workers the scheduler runs in the leader process, the others report the status it saved
+    status = get_saved_scheduler_status()
+    return jsonify(status if status is not None else {'running': False})
+
+async def refresh_query_for_bot(bot_name):
+    print(f"Refreshing query for bot: {bot_name}")
+    print(f"Generating new query IDs for the {bot_name} bot:")
+    await generate_queries_for_all_sessions([bot_name])
     
-    return proxies
+    # Fetch and return the updated queries
+    queries = await asyncio.to_thread(fetch_queries, bot_username=bot_name)
+    print("Database accessed: queries refreshed")  # Log to console on each access
+    return {'queries': [dict(row) for row in queries]}  # Return the queries in the expected format
+
+# Refresh some bots of one registry session, used by the refresh scheduler
+async def refresh_scheduled_session(row, bots, on_result=None):
+    print(f"\nScheduled refresh of session file: {os.path.basename(row['path'])}")
+    max_age = max(pipeline.query_max_age - scheduler.lead, 0) if scheduler is not None else None
+    return await generate_queries_with_retries(row['session_string'], bots, identity=session_identity(row),
+                                               on_result=on_result, max_age=max_age)
+
+# Refresh the missing and stale queries in the background, then keep them warm with the scheduler
+# unless SCHEDULER_ENABLED is false. Returns the refresh job, or None when --workers runs the refresh.
+def start_background_refresh(workers: int = 1):
+    global scheduler
+
+    if (os.getenv('SCHEDULER_ENABLED') or 'true').strip().lower() not in ('0', 'false', 'no'):
+        scheduler = RefreshScheduler(pipeline.usernames, pipeline.query_max_age, refresh_scheduled_session)
+
+    print(f"Refreshing query IDs older than {pipeline.query_max_age} seconds in the background for the following usernames:")
+    for username in pipeline.usernames:
+        print(f"- {username}")
+    if workers > 1:
+        threading.Thread(target=run_sharded_startup_refresh, args=(pipeline.usernames, workers),
+                         name='startup-refresh', daemon=True).start()
+        return None
 
-# Example usage
-if __name__ == '__main__':
-    load_dotenv(find_dotenv())
+    # Runs on the same background loop the API uses
+    job = create_job(pipeline.usernames, pipeline.query_max_age)
+    submit(run_startup_refresh(job))
+    return job
 
-    api_id = os.getenv('API_ID')
-    api_hash = os.getenv('API_HASH')
-    usernames_str = os.getenv('BOT_USERNAMES')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate query IDs and serve them over the API")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="split the startup refresh over this many processes (default 1)")
+    args = parser.parse_args()
 
-    if api_id is None or api_hash is None:
-        print("Error: API_ID and API_HASH must be set in the .env file.")
+    if args.workers < 1:
+        print("Error: --workers must be at least 1.")
         exit(1)
 
-    if api_id.strip() == "" or api_hash.strip() == "":
-        print("Error: API_ID and API_HASH cannot be empty.")
-        exit(1)
+    load_settings()
 
-    try:
-        api_id = int(api_id)
-    except ValueError:
-        print("Error: API_ID must be an integer.")
-        exit(1)
+    # Register the signal handler for Ctrl+C (SIGINT)
+    signal.signal(signal.SIGINT, signal_handler)
 
-    # Validate BOT_USERNAMES
-    if usernames_str is None:
-        print("Error: BOT_USERNAMES must be set in the .env file.")
-        exit(1)
+    init_db()  # Create or migrate the database, the rows of the last run are kept
+
+    # The API serves the existing rows right away, the missing and stale ones are generated in the background
+    startup_job = start_background_refresh(args.workers)
+    if startup_job is not None:
+        print(f"Follow the progress at http://127.0.0.1:3000/api/jobs/{startup_job.id}")
 
-    usernames = [username.strip() for username in usernames_str.split(",") if username.strip()]
-    
-    if not usernames:
-        print("Error: BOT_USERNAMES cannot be empty.")
-        exit(1)
-    
-    init_db()  # Initialize the database once at startup
-    init_db2()
-    init_db3()
-    print("Generating query IDs for the following usernames:")
-    for username in usernames:
-        print(f"- {username}")
-        try:
-           asyncio.run(generate_queries_for_all_sessions(username))
-        except KeyboardInterrupt:
-           print("Process interrupted by user. Exiting gracefully...")
-        except RuntimeError as e:
-           if 'Event loop stopped before Future completed' in str(e):
-               print("Warning: The event loop was stopped before all tasks were completed. Exiting gracefully...")
-           else:
-               print(f"Unexpected runtime error: {e}")
-    
     print("head over to the site http://127.0.0.1:3000 to read the api docs")
-    app.run(port=3000)
+    try:
+        app.run(port=3000, threaded=True)  # Each request gets its own thread, refreshes run on the background loop
+    except KeyboardInterrupt:
+        pass
@@ -6,6 +6,7 @@ def display_menu():
     print("Choose an option:")
     print("1. Generate query ID of games")
     print("2. Create session")
+    print("3. Export query IDs to files (batch mode, no API)")
     print("0. Exit")
 
 def generate_query_id():
@@ -19,6 +20,17 @@ def generate_query_id():
     except Exception as e:
         print(f"An error occurred: {e}")
 
+def export_query_ids():
+    # Run the batch mode, the queries end up in the exports folder, one file per bot
+    try:
+        subprocess.run(["python3", "cli.py"], check=True)
+    except FileNotFoundError:
+        print("Error: The file 'cli.py' was not found.")
+    except KeyboardInterrupt:
+        print("Process interrupted by user.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
 def create_session():
     # Run another Python script using subprocess
     print("Creating session...")
@@ -43,6 +55,11 @@ def main():
                 generate_query_id()
             elif choice == "2":
                 create_session()
+            elif choice == "3":
+                if not os.path.exists('sessions'):
+                    print("Error: 'sessions' folder not found. Please create it before proceeding.")
+                    continue  # Go back to the menu
+                export_query_ids()
             elif choice == "0":
                 print("Exiting...")
                 break
@@ -0,0 +1,166 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from storage import save_process_state, get_process_states, prune_process_states
+
+# Latency buckets in seconds, from a cached DB write up to a slow Telegram round trip
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SHARE_INTERVAL = 5  # Seconds between saves of the values of this process, see share_metrics
+
+# Metrics are updated from the event loop, the writer thread and the Flask threads.
+# Every update is a dict lookup and an increment under a lock, cheap enough to leave on.
+_registry = []
+_shared_key = None  # Key of the values of this process in the process_state table once they are shared
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+# Monotonic counter with labels, e.g. query_results_total{bot="...",result="success"}
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    # others are the snapshots of the other processes, added to the values of this one
+    def render(self, others=()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for other in others:
+            for key, value in other:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}")
+        return lines
+
+# Histogram with labels, the buckets are kept per bucket and made cumulative when rendered
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # {label values: [count per bucket..., count above the last bucket]}
+        self._sums = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[index] += 1
+            self._sums[key] += value
+
+    # Observe the duration of the block, also when it raises
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(counts), self._sums[key]] for key, counts in self._values.items()]
+
+    def render(self, others=()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = {key: (list(counts), self._sums[key]) for key, counts in self._values.items()}
+        for other in others:
+            for key, counts, total in other:
+                if len(counts) != len(self.buckets) + 1:
+                    continue  # Saved with other buckets
+                merged, merged_total = values.get(tuple(key), ([0] * len(counts), 0.0))
+                values[tuple(key)] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_number(bound))])} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+# Every metric in the Prometheus text format, summed over the processes sharing their values
+def render_metrics() -> str:
+    others = []
+    if _shared_key is not None:
+        states = get_process_states('metrics:', 3 * SHARE_INTERVAL)
+        states.pop(_shared_key, None)
+        others = list(states.values())
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render([state.get(metric.name, []) for state in others]))
+    return '\n'.join(lines) + '\n'
+
+# Save the values of this process every SHARE_INTERVAL and add the ones the other processes saved to
+# render_metrics, used by asgi.py where every worker process counts on its own. The values of a
+# process that is gone drop out after a few intervals, scrapers see that as a counter reset.
+def share_metrics():
+    global _shared_key
+    if _shared_key is not None:
+        return
+    _shared_key = f"metrics:{os.getpid()}"
+    threading.Thread(target=_share_loop, name='metrics-share', daemon=True).start()
+
+def _share_loop():
+    while True:
+        try:
+            save_process_state(_shared_key, {metric.name: metric.snapshot() for metric in _registry})
+            prune_process_states('metrics:', 3 * SHARE_INTERVAL)
+        except Exception as e:
+            print(f"Could not share the metrics of this process: {e}")
+        time.sleep(SHARE_INTERVAL)
+
+# Time spent in each phase of a query generation:
+# proxy_check, connect, get_me, resolve (bot username), web_view (RequestAppWebViewRequest), db_insert
+PHASE_SECONDS = Histogram('query_phase_seconds', "Duration of each phase of a query generation", ('phase',))
+
+# Outcome of every request for a query: success, failure or flood_wait (retried FloodWaits count too)
+QUERY_RESULTS = Counter('query_results_total', "Query generation outcomes per bot and proxy", ('bot', 'proxy', 'result'))
+
+# Outcome of every proxy probe: healthy or unhealthy
+PROXY_CHECKS = Counter('proxy_checks_total', "Proxy health probes per proxy", ('proxy', 'result'))
+
+# Rows written by the batch writer
+DB_ROWS_WRITTEN = Counter('db_rows_written_total', "Rows written to the database by the batch writer")
+
+# Proxy label without the credentials, "direct" when no proxy is used
+def proxy_label(proxy) -> str:
+    if proxy is None:
+        return 'direct'
+    return f"{proxy.host}:{proxy.port}"
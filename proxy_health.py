@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+from storage import save_proxy_status, get_proxy_status
+from metrics import PHASE_SECONDS, PROXY_CHECKS, proxy_label
+from settings import env_number
+
+# Probe used when PROXY_CHECK_URL is not set, point it at a local stand-in to avoid httpbin
+DEFAULT_CHECK_URL = "https://httpbin.org/ip"
+DEFAULT_CHECK_TIMEOUT = 10  # Seconds to wait for the probe
+DEFAULT_CHECK_TTL = 300  # Seconds a proxy status stays valid before it is checked again
+
+# Checks running right now, so concurrent callers share a single probe per proxy
+_in_flight = {}
+
+def get_check_url():
+    return os.getenv('PROXY_CHECK_URL') or DEFAULT_CHECK_URL
+
+def get_check_ttl():
+    return env_number('PROXY_CHECK_TTL', DEFAULT_CHECK_TTL)
+
+# Return the cached status of a proxy, or None when it was never checked or the entry expired
+def get_cached_proxy_status(proxy_str: str):
+    status = get_proxy_status(proxy_str)
+    if status is None or time.time() - status[1] > get_check_ttl():
+        return None
+    return status[0]
+
+# Mark a proxy as dead, e.g. when a connection through it failed mid-run
+def mark_proxy_unhealthy(proxy_str: str, error: str = None):
+    print(f"Marking proxy as unhealthy: {proxy_str}")
+    save_proxy_status(proxy_str, False, error)
+
+# Blocking probe of a single proxy, returns (healthy, error)
+def validate_proxy(proxy_str: str):
+    # Imported on the first check, runs without proxies never load them
+    import requests
+    from better_proxy import Proxy
+
+    try:
+        # Parse the proxy using better_proxy
+        proxy = Proxy.from_str(proxy_str)
+
+        # Set up the requests proxy dictionary
+        proxy_dict = {
+            "http": f"{proxy.protocol}://{proxy.login}:{proxy.password}@{proxy.host}:{proxy.port}",
+            "https": f"{proxy.protocol}://{proxy.login}:{proxy.password}@{proxy.host}:{proxy.port}"
+        }
+
+        # Test a request through the proxy
+        timeout = env_number('PROXY_CHECK_TIMEOUT', DEFAULT_CHECK_TIMEOUT)
+        response = requests.get(get_check_url(), proxies=proxy_dict, timeout=timeout)
+
+        # Check if we got a successful response
+        if response.status_code == 200:
+            print(f"Proxy is working! {proxy_str}")
+            return True, None
+        else:
+            print("Proxy failed with status code:", response.status_code)
+            return False, f"status code {response.status_code}"
+
+    except requests.exceptions.ProxyError as pe:
+        print(f"Proxy connection error: {pe}")
+        return False, str(pe)
+    except requests.exceptions.Timeout:
+        print("Request timed out while trying to connect through the proxy.")
+        return False, "timeout"
+    except Exception as e:
+        print(f"Proxy validation failed: {e}")
+        return False, str(e)
+
+async def _check_and_store(proxy_str: str):
+    try:
+        # The probe is blocking, keep it off the event loop
+        with PHASE_SECONDS.time(phase='proxy_check'):
+            healthy, error = await asyncio.to_thread(validate_proxy, proxy_str)
+        try:
+            from better_proxy import Proxy
+            label = proxy_label(Proxy.from_str(proxy_str))
+        except Exception:
+            label = 'invalid'
+        PROXY_CHECKS.inc(proxy=label, result='healthy' if healthy else 'unhealthy')
+        await asyncio.to_thread(save_proxy_status, proxy_str, healthy, error)
+        return healthy
+    finally:
+        _in_flight.pop(proxy_str, None)
+
+# Return whether a proxy is usable, probing it only when the cached status expired
+async def is_proxy_healthy(proxy_str: str, force: bool = False) -> bool:
+    if not force:
+        cached = await asyncio.to_thread(get_cached_proxy_status, proxy_str)
+        if cached is not None:
+            return cached
+
+    task = _in_flight.get(proxy_str)
+    if task is None:
+        task = asyncio.ensure_future(_check_and_store(proxy_str))
+        _in_flight[proxy_str] = task
+    return await task
+
+# Check many proxies concurrently and return {proxy: healthy}
+async def check_proxies(proxies, force: bool = False):
+    proxies = [proxy for proxy in dict.fromkeys(proxies) if proxy]
+    statuses = await asyncio.gather(*(is_proxy_healthy(proxy, force) for proxy in proxies))
+    return dict(zip(proxies, statuses))
@@ -0,0 +1,88 @@
+import random
+import asyncio
+from contextlib import asynccontextmanager
+from storage import get_proxy_assignment, save_proxy_assignment, delete_proxy_assignment
+from proxy_health import is_proxy_healthy, check_proxies, mark_proxy_unhealthy
+
+# Raised when a session could not connect through its proxy, the session is moved to another one
+class ProxyConnectionFailed(ConnectionError):
+    def __init__(self, proxy: str, error: Exception):
+        super().__init__(f"Could not connect through proxy {proxy}: {error}")
+        self.proxy = proxy
+
+# Pool of the proxies from proxies.txt.
+# - every session sticks to the proxy it was assigned, the assignment is kept in the proxies table
+# - every proxy serves at most max_per_proxy sessions at the same time
+# - new assignments prefer healthy proxies with a good success rate and free capacity
+# - a proxy that dies mid-run is marked unhealthy and its sessions move to another proxy
+class ProxyPool:
+    def __init__(self, proxies, max_per_proxy: int):
+        self.proxies = list(dict.fromkeys(proxies))
+        self.max_per_proxy = max_per_proxy
+        self.limits = {proxy: asyncio.Semaphore(max_per_proxy) for proxy in self.proxies}
+        self.in_use = {proxy: 0 for proxy in self.proxies}
+        self.successes = {proxy: 0 for proxy in self.proxies}
+        self.failures = {proxy: 0 for proxy in self.proxies}
+
+    def __len__(self):
+        return len(self.proxies)
+
+    # Check every proxy concurrently, the statuses are cached by proxy_health
+    async def check_all(self):
+        return await check_proxies(self.proxies)
+
+    # Success rate of a proxy in this run, unknown proxies start at 0.5
+    def score(self, proxy: str) -> float:
+        return (self.successes[proxy] + 1) / (self.successes[proxy] + self.failures[proxy] + 2)
+
+    async def _choose(self, exclude=()):
+        candidates = [proxy for proxy in self.proxies if proxy not in exclude]
+        statuses = await asyncio.gather(*(is_proxy_healthy(proxy) for proxy in candidates))
+        healthy = [proxy for proxy, ok in zip(candidates, statuses) if ok]
+        if not healthy:
+            return None
+        # Weighted by health and by the capacity that is still free, so the load spreads out
+        weights = [self.score(proxy) * (max(self.max_per_proxy - self.in_use[proxy], 0) + 0.1) for proxy in healthy]
+        return random.choices(healthy, weights)[0]
+
+    # Return the proxy of a session, assigning one when it has none or its proxy is gone or dead.
+    # None means the session connects directly, which only happens when the pool is empty.
+    async def assign(self, session: str, exclude=()):
+        if not self.proxies:
+            return None
+
+        proxy = await asyncio.to_thread(get_proxy_assignment, session)
+        if proxy in self.limits and proxy not in exclude and await is_proxy_healthy(proxy):
+            return proxy
+
+        proxy = await self._choose(exclude)
+        if proxy is None:
+            raise ConnectionError("No healthy proxy left in the pool")
+        await asyncio.to_thread(save_proxy_assignment, session, proxy)
+        return proxy
+
+    # Hold a slot of the proxy of a session for the duration of the block
+    @asynccontextmanager
+    async def lease(self, session: str, exclude=()):
+        proxy = await self.assign(session, exclude)
+        if proxy is None:
+            yield None
+            return
+
+        async with self.limits[proxy]:
+            self.in_use[proxy] += 1
+            try:
+                yield proxy
+            finally:
+                self.in_use[proxy] -= 1
+
+    def report_success(self, proxy: str):
+        if proxy in self.successes:
+            self.successes[proxy] += 1
+
+    # The proxy failed to connect: mark it unhealthy and drop the session's assignment, off the event loop
+    async def report_failure(self, proxy: str, session: str, error: str = None):
+        if proxy in self.failures:
+            self.failures[proxy] += 1
+        await asyncio.to_thread(mark_proxy_unhealthy, proxy, error)
+        await asyncio.to_thread(delete_proxy_assignment, session)
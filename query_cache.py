@@ -0,0 +1,212 @@
+import time
+import bisect
+import threading
+from storage import get_connection, get_queries_version, get_changes, get_latest_change_seq, add_change_listener, ChangesPruned
+from settings import env_number
+
+DEFAULT_CHECK_INTERVAL = 1.0  # Seconds between checks of the database version, catches writes of other processes
+
+# Snapshot of the queries table indexed by user_id, by bot_username and by both, plus the
+# user_ids of the registered sessions. Reads are dict lookups on an immutable snapshot.
+# The writes of this process mark it stale right after their commit (see storage.add_change_listener),
+# writes of other processes are noticed through the version of the queries table. A stale snapshot
+# catches up through the change log: only the (user_id, bot) rows upserted or deleted since are read again and
+# swapped into a copy of the indexes, the whole table is only loaded again after a long gap.
+class QueryCache:
+    def __init__(self, check_interval=None):
+        self.check_interval = check_interval
+        if self.check_interval is None:
+            self.check_interval = env_number('QUERY_CACHE_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)
+        self.version = None  # Version of the queries table the snapshot was loaded at
+        self.loads = 0
+        self._stale = True
+        self._checked_at = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    # Drop the snapshot, the next read loads it again
+    def invalidate(self):
+        self._stale = True
+
+    def _current(self):
+        now = time.monotonic()
+        if not self._stale and now - self._checked_at < self.check_interval:
+            return self._snapshot
+
+        with self._lock:
+            if not self._stale and now - self._checked_at < self.check_interval:
+                return self._snapshot  # Another thread loaded it in the meantime
+            version = get_queries_version()
+            self._checked_at = now
+            if self._stale or version != self.version:
+                self._stale = False  # Cleared before the update, so a write during the update marks it stale again
+                self._snapshot = self._update(self._snapshot)
+                self.version = self._snapshot['version']
+            return self._snapshot
+
+    # Return the next snapshot, read in one transaction so the rows, the version and the seq match
+    def _update(self, snapshot):
+        db = get_connection()
+        own_transaction = not db.in_transaction
+        if own_transaction:
+            db.execute('BEGIN')
+        try:
+            if snapshot is not None:
+                updated = self._catch_up(db, snapshot)
+                if updated is not None:
+                    return updated
+            self.loads += 1
+            return self._load(db)
+        finally:
+            if own_transaction:
+                db.execute('COMMIT')
+
+    def _load(self, db):
+        rowids = []
+        rows = []
+        by_user = {}
+        by_bot = {}
+        by_user_bot = {}
+        for row in db.execute('SELECT rowid, * FROM queries ORDER BY rowid'):
+            query = dict(row)
+            rowid = query.pop('rowid')
+            rowids.append(rowid)
+            rows.append(query)
+            # Every index keeps its rows in rowid order, as ([rowids], [rows])
+            for index, key in ((by_user, query['user_id']), (by_bot, query['bot_username']),
+                               (by_user_bot, (query['user_id'], query['bot_username']))):
+                entry = index.get(key)
+                if entry is None:
+                    entry = index[key] = ([], [])
+                entry[0].append(rowid)
+                entry[1].append(query)
+        return {'all': (rowids, rows), 'by_user': by_user, 'by_bot': by_bot, 'by_user_bot': by_user_bot,
+                'users': _load_users(db), 'version': get_queries_version(), 'seq': get_latest_change_seq()}
+
+    # Apply the change log entries after the seq of the snapshot to a copy of it.
+    # Returns None when loading everything again is the better option.
+    def _catch_up(self, db, snapshot):
+        limit = max(len(snapshot['all'][0]) // 4, 100)
+        try:
+            changes = get_changes(snapshot['seq'], limit + 1)
+        except ChangesPruned:
+            return None
+        if len(changes) > limit:
+            return None  # A full refresh, cheaper to load the table again
+
+        # The (user_id, bot) pairs to read again: the upserted ones and every pair of a deleted account
+        pairs = {}
+        for change in changes:
+            if change['op'] == 'upsert':
+                pairs[(change['user_id'], change['bot_username'])] = None
+            elif change['op'] == 'delete' and change['user_id'] is not None and change['bot_username'] is None:
+                for query in snapshot['by_user'].get(change['user_id'], ([], []))[1]:
+                    pairs[(change['user_id'], query['bot_username'])] = None
+            else:
+                return None
+
+        # Only the entries touched by the changes are copied, the snapshot readers hold stays as it is
+        rowids, rows = snapshot['all']
+        updated = dict(snapshot, all=(list(rowids), list(rows)), by_user=dict(snapshot['by_user']),
+                       by_bot=dict(snapshot['by_bot']), by_user_bot=dict(snapshot['by_user_bot']))
+        copied = set()
+
+        def writable(index_name, key):
+            index = updated[index_name]
+            if (index_name, key) not in copied or key not in index:  # Not copied yet, or emptied and dropped
+                entry_rowids, entry_rows = index.get(key, ([], []))
+                index[key] = (list(entry_rowids), list(entry_rows))
+                copied.add((index_name, key))
+            return index[key]
+
+        for user_id, bot_username in pairs:
+            old_rowids = snapshot['by_user_bot'].get((user_id, bot_username), ([], []))[0]
+            entries = (updated['all'], writable('by_user', user_id), writable('by_bot', bot_username))
+            for entry in entries:
+                for rowid in old_rowids:
+                    _remove(entry, rowid)
+
+            # The current row of the pair, a refreshed query replaced the old one under a new rowid, a deleted one is gone
+            pair = ([], [])
+            for row in db.execute('SELECT rowid, * FROM queries WHERE user_id = ? AND bot_username = ? ORDER BY rowid',
+                                  (user_id, bot_username)):
+                query = dict(row)
+                rowid = query.pop('rowid')
+                for entry in entries + (pair,):
+                    _insert(entry, rowid, query)
+            updated['by_user_bot'][(user_id, bot_username)] = pair
+
+            # Lookups tell missing users and bots apart by their key, so empty entries go away
+            for index_name, key in (('by_user', user_id), ('by_bot', bot_username), ('by_user_bot', (user_id, bot_username))):
+                if not updated[index_name][key][0]:
+                    del updated[index_name][key]
+
+        updated['users'] = _load_users(db)
+        updated['version'] = get_queries_version()
+        updated['seq'] = changes[-1]['seq'] if changes else snapshot['seq']
+        return updated
+
+    # Version of the queries table the rows are from, used for the ETag
+    def get_version(self) -> int:
+        return self._current()['version']
+
+    # Whether the user_id belongs to a registered session
+    def has_user(self, user_id) -> bool:
+        return _as_user_id(user_id) in self._current()['users']
+
+    def has_bot(self, bot_username: str) -> bool:
+        return bot_username in self._current()['by_bot']
+
+    # Return ([rowids], [rows]) of the queries in insertion order, optionally filtered by user ID and/or bot name,
+    # only after the row with the given rowid and at most limit rows. The rows are shared, don't modify them.
+    def get(self, user_id=None, bot_username=None, after=None, limit=None):
+        snapshot = self._current()
+        if user_id and bot_username:
+            entry = snapshot['by_user_bot'].get((_as_user_id(user_id), bot_username), ([], []))
+        elif user_id:
+            entry = snapshot['by_user'].get(_as_user_id(user_id), ([], []))
+        elif bot_username:
+            entry = snapshot['by_bot'].get(bot_username, ([], []))
+        else:
+            entry = snapshot['all']
+
+        rowids, rows = entry
+        start = bisect.bisect_right(rowids, after) if after is not None else 0
+        end = len(rowids) if limit is None else start + limit
+        return rowids[start:end], rows[start:end]
+
+def _load_users(db):
+    return {row[0] for row in db.execute('SELECT DISTINCT user_id FROM sessions WHERE user_id IS NOT NULL')}
+
+# Remove a row from an index entry, ([rowids], [rows]) in rowid order
+def _remove(entry, rowid):
+    rowids, rows = entry
+    index = bisect.bisect_left(rowids, rowid)
+    if index < len(rowids) and rowids[index] == rowid:
+        del rowids[index]
+        del rows[index]
+
+def _insert(entry, rowid, query):
+    rowids, rows = entry
+    index = bisect.bisect_left(rowids, rowid)
+    rowids.insert(index, rowid)
+    rows.insert(index, query)
+
+# user_ids come in as strings from the query string
+def _as_user_id(user_id):
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return user_id
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# Return the cache of this process, registering it for the change notifications on first use
+def get_query_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QueryCache()
+            add_change_listener(_cache.invalidate)
+        return _cache
@@ -0,0 +1,546 @@
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import deque
+from contextlib import AsyncExitStack
+from urllib.parse import unquote
+from telethon import TelegramClient
+from telethon.errors import (
+    FloodWaitError, PeerIdInvalidError, UserIdInvalidError, BotInvalidError, InputUserDeactivatedError
+)
+from telethon.types import InputBotAppShortName, InputUser, InputPeerUser
+from telethon.sessions import StringSession
+from telethon import functions
+from dotenv import load_dotenv, find_dotenv
+from query_writer import get_query_writer, collect_rows
+from session_registry import scan_sessions
+from refresh_scheduler import stale_bots
+from rate_limiter import FloodParked, get_rate_limiter
+from storage import (
+    get_query_auth_dates, get_session_by_string, get_bot_peer, save_bot_peer, delete_bot_peer, get_registered_sessions,
+    write_batch
+)
+from proxy_pool import ProxyPool, ProxyConnectionFailed
+from work_leases import WorkLeased, get_lease_manager
+from metrics import PHASE_SECONDS, QUERY_RESULTS, proxy_label
+
+# The query generation pipeline: Telethon sessions in, queries out, without the web server.
+# generate_query_id.py serves it over the API, cli.py runs it as a batch job.
+
+# Global variables
+api_id = None
+api_hash = None
+usernames = []
+proxy_pool = None  # Created from proxies.txt on first use, see get_proxy_pool
+max_concurrency = 10  # Sessions processed at the same time
+max_concurrency_per_proxy = 2  # Sessions sharing one proxy processed at the same time
+query_max_age = 3600  # Seconds after which a query counts as stale for incremental refreshes
+MAX_PROXY_SWITCHES = 3  # Proxies a session may try before it fails
+
+# Errors meaning a cached bot peer is no longer valid for this account
+STALE_PEER_ERRORS = (PeerIdInvalidError, UserIdInvalidError, BotInvalidError, InputUserDeactivatedError)
+
+# Request the web app of one bot through the given peer and return the query
+async def request_web_app(client, peer_id: int, access_hash: int):
+    with PHASE_SECONDS.time(phase='web_view'):
+        webapp_response = await client(functions.messages.RequestAppWebViewRequest(
+            peer=InputPeerUser(peer_id, access_hash),
+            app=InputBotAppShortName(bot_id=InputUser(peer_id, access_hash), short_name="app"),
+            platform="ios",
+            write_allowed=True,
+            start_param="6094625904"
+        ))
+
+    # Parse query data from the URL
+    return unquote(webapp_response.url.split("tgWebAppData=")[1].split("&")[0])
+
+# Request the web app of one bot over an already connected client and return the query.
+# The bot peer is taken from the cache of this account, so the username is only resolved once.
+# The cache lives in the database, its reads and writes may wait for the write lock, keep them off the loop.
+async def request_query(client, user_id: int, bot_username: str):
+    cached = await asyncio.to_thread(get_bot_peer, user_id, bot_username)
+    if cached is not None:
+        try:
+            return await request_web_app(client, *cached)
+        except STALE_PEER_ERRORS as e:
+            print(f"Cached peer of bot {bot_username} was rejected ({e}), resolving it again")
+            await asyncio.to_thread(delete_bot_peer, user_id, bot_username)
+
+    with PHASE_SECONDS.time(phase='resolve'):
+        entity = await client.get_input_entity(bot_username)
+    await asyncio.to_thread(save_bot_peer, user_id, bot_username, entity.user_id, entity.access_hash)
+    return await request_web_app(client, entity.user_id, entity.access_hash)
+
+# Return the cached (user_id, name, username) of a registry row, or None when get_me is still needed
+def session_identity(row):
+    if row['user_id'] is None:
+        return None
+    return row['user_id'], row['name'], row['username']
+
+# Function to generate query IDs for every bot over a single connection of one session string.
+# When the identity of the account is already known, get_me is skipped.
+# on_result(bot_username, user_id, query, error) is called as soon as each bot is done.
+# Bots waiting for a long flood deadline come back as FloodParked instead of blocking the connection.
+async def generate_queries_for_session(session: str, bot_usernames, proxy=None, flush=False, identity=None, on_result=None):
+    global api_id, api_hash  # Access the global variables
+
+    if isinstance(bot_usernames, str):
+        bot_usernames = [bot_usernames]
+
+    proxy_key = proxy
+    # Check and parse the proxy if provided
+    if proxy:
+        from better_proxy import Proxy  # Only sessions running through a proxy need it
+        proxy = Proxy.from_str(proxy)  # Parse the proxy string
+        proxy_string = str(proxy)
+        proxy_dict = dict(
+            proxy_type=proxy.protocol,
+            addr=proxy.host,
+            port=proxy.port,
+            username=proxy.login,
+            password=proxy.password
+        )
+    else:
+        proxy_dict= None
+        proxy_string = None
+    proxy_name = proxy_label(proxy)  # Metrics label, without the credentials
+
+    client = TelegramClient(StringSession(session), api_id, api_hash)
+    if proxy_dict:
+        client.session.proxy = proxy_dict
+        print(f"Using proxy: {proxy}")
+    else:
+        print("No proxy is beign used")
+
+    writer = get_query_writer()  # Rows are written in batches by a single writer task
+    limiter = get_rate_limiter()  # Flood deadlines and request rate shared by every session
+    results = {}
+    try:
+        # Connect and identify the account once, then reuse the connection for every bot
+        try:
+            with PHASE_SECONDS.time(phase='connect'):
+                await client.connect()
+        except Exception as e:
+            if proxy_key is not None:
+                raise ProxyConnectionFailed(proxy_key, e) from e  # The pool moves the session to another proxy
+            raise
+        if identity is None:
+            with PHASE_SECONDS.time(phase='get_me'):
+                me = await client.get_me()
+            name = me.first_name + " " + (me.last_name if me.last_name else "")
+            user_id = me.id
+            username = me.username
+            writer.put_session(user_id, name, username, session)  # Cache the identity in the session registry
+        else:
+            user_id, name, username = identity
+
+        pending = deque(bot_usernames)
+        while pending:
+            bot_username = pending.popleft()
+
+            # Park the bot when its flood deadline is far away, short waits are slept through
+            wait = limiter.flood_wait(session, bot_username)
+            if wait > limiter.park_after:
+                results[bot_username] = FloodParked(bot_username, wait)
+                continue
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            await limiter.acquire(session)  # Per-account request rate cap
+            try:
+                query = await request_query(client, user_id, bot_username)
+            except FloodWaitError as e:
+                # A flood on resolving usernames holds for the whole account, otherwise only for this bot
+                account_wide = isinstance(e.request, functions.contacts.ResolveUsernameRequest)
+                print(f"Rate limit encountered for bot {bot_username}. Waiting for {e.seconds} seconds...")
+                QUERY_RESULTS.inc(bot=bot_username, proxy=proxy_name, result='flood_wait')
+                if limiter.record_flood(session, bot_username, e.seconds, account_wide):
+                    pending.append(bot_username)  # Retried once its deadline passed
+                    continue
+                print(f"Giving up on bot {bot_username} after {limiter.max_retries} FloodWaits")
+                error = e
+            except Exception as e:
+                # A failing bot doesn't stop the remaining bots of this session
+                print(f"Error while generating query for bot {bot_username}: {e}")
+                error = e
+            else:
+                error = None
+
+            if error is not None:
+                QUERY_RESULTS.inc(bot=bot_username, proxy=proxy_name, result='failure')
+                results[bot_username] = error
+                if on_result:
+                    on_result(bot_username, user_id, None, error)
+                continue
+
+            limiter.record_success(session, bot_username)
+            QUERY_RESULTS.inc(bot=bot_username, proxy=proxy_name, result='success')
+            print(f"Successfully Query ID generated for user {name} | Bot: {bot_username} | username: {username}")
+            print()
+            writer.put_query(user_id, bot_username, query, name, proxy_string)  # Queue the query for the database
+            results[bot_username] = query
+            if on_result:
+                on_result(bot_username, user_id, query, None)
+
+    except Exception as e:
+        print(f"Error while generating query: {e}")
+        raise  # Let the caller decide, so one bad session doesn't stop the others
+
+    finally:
+        await client.disconnect()
+        if flush:
+            await writer.flush()  # Callers reading the database right after need the rows committed
+
+    return results
+
+# Run generate_queries_for_session until no bot is parked anymore. While parked bots wait for their
+# flood deadline the connection is closed and the slots are released, so other sessions keep moving.
+# Retries are bounded by the FloodWaits the rate limiter allows per (session, bot).
+# The proxy comes from the pool, a proxy failing to connect is replaced by another one.
+# Every (session, bot) is claimed in the work_leases table first, bots claimed by another instance
+# sharing the database come back as WorkLeased. With max_age, bots whose query another instance
+# refreshed in the meantime are released again without generating them.
+async def generate_queries_with_retries(session: str, bot_usernames, flush=False, identity=None, on_result=None, slots=(),
+                                        max_age=None):
+    if isinstance(bot_usernames, str):
+        bot_usernames = [bot_usernames]
+
+    leases = get_lease_manager()
+    claimed = await leases.claim(session, bot_usernames)
+    leased = {bot_username: WorkLeased(bot_username) for bot_username in bot_usernames if bot_username not in claimed}
+    if max_age is not None and identity is None and claimed:
+        # Another instance may have identified the account since this one scanned the sessions
+        row = await asyncio.to_thread(get_session_by_string, session)
+        identity = session_identity(row) if row is not None else None
+    if max_age is not None and identity is not None and claimed:
+        auth_dates = await asyncio.to_thread(get_query_auth_dates, claimed)
+        stale = stale_bots(identity, claimed, auth_dates, max_age)
+        fresh = [bot_username for bot_username in claimed if bot_username not in stale]
+        await leases.release(session, fresh)
+        leased.update((bot_username, WorkLeased(bot_username, done=True)) for bot_username in fresh)
+        claimed = stale
+    for bot_username, error in leased.items():
+        print(error)
+        if on_result:
+            on_result(bot_username, identity[0] if identity else None, None, error)
+
+    try:
+        results = await _generate_claimed(session, claimed, identity, on_result, slots)
+    finally:
+        leases.release_after_write(get_query_writer(), session, claimed)
+
+    results.update(leased)
+    if flush:
+        await get_query_writer().flush()  # Callers reading the database right after need the rows committed
+    return results
+
+async def _generate_claimed(session: str, bot_usernames, identity, on_result, slots):
+    limiter = get_rate_limiter()
+    pool = get_proxy_pool()
+    results = {}
+    pending = list(bot_usernames)
+    dead_proxies = set()
+    while pending:
+        try:
+            async with AsyncExitStack() as stack:
+                for slot in slots:
+                    await stack.enter_async_context(slot)
+                proxy = await stack.enter_async_context(pool.lease(session, exclude=dead_proxies))
+                outcome = await generate_queries_for_session(session, pending, proxy, identity=identity, on_result=on_result)
+        except ProxyConnectionFailed as e:
+            await pool.report_failure(e.proxy, session, str(e))
+            dead_proxies.add(e.proxy)
+            if len(dead_proxies) < MAX_PROXY_SWITCHES:
+                print(f"{e}, switching to another proxy")
+                continue
+            failure = e
+        except Exception as e:
+            failure = e
+        else:
+            failure = None
+            if proxy is not None:
+                pool.report_success(proxy)
+
+        if failure is not None:
+            if not results:
+                raise failure
+            # Some bots were done before, only the parked ones failed
+            for bot_username in pending:
+                results[bot_username] = failure
+                if on_result:
+                    on_result(bot_username, identity[0] if identity else None, None, failure)
+            break
+
+        results.update(outcome)
+        pending = [bot_username for bot_username, result in outcome.items() if isinstance(result, FloodParked)]
+        if pending:
+            wait = min(limiter.flood_wait(session, bot_username) for bot_username in pending)
+            print(f"Parking {len(pending)} bots of this session for {wait:.0f} seconds, other sessions keep going")
+            await asyncio.sleep(wait)
+
+    return results
+
+# Function to generate query ID for a single session string and a single bot
+async def generate_query(session: str, bot_username: str, flush=True, identity=None):
+    result = (await generate_queries_with_retries(session, [bot_username], flush, identity))[bot_username]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+# Run the queries of one session while holding a global slot, the proxy slot is taken by the pool.
+# Returns {bot: query or exception}, also when the whole session failed.
+async def generate_queries_limited(session_file: str, session: str, bot_usernames, identity, global_limit, progress=None,
+                                   max_age=None):
+    results = {}  # Every bot reported so far, kept when the session fails later on
+
+    def on_result(bot_username, user_id, query, error):
+        results[bot_username] = error if error is not None else query
+        if progress is not None:
+            progress.record(session_file, bot_username, user_id, query, error)
+
+    print(f"\nProcessing session file: {session_file}")
+    try:
+        return await generate_queries_with_retries(session, bot_usernames, identity=identity, on_result=on_result,
+                                                   slots=(global_limit,), max_age=max_age)
+    except Exception as e:
+        # Only the bots not reported yet failed with the session, not e.g. the ones left to another instance
+        print(f"Session {session_file} failed: {e}")
+        for bot_username in bot_usernames:
+            if bot_username not in results:
+                on_result(bot_username, identity[0] if identity else None, None, e)
+        return results
+
+
+# Function to load session strings from the session folder ('sessions' by default) and generate queries for the given bots.
+# progress, e.g. a RefreshJob, gets start(total) once and record(...) for every (session, bot) row.
+# With max_age only the queries that are missing or older than max_age seconds are generated again.
+# session_paths restricts the run to these session files, used by the --workers processes.
+async def generate_queries_for_all_sessions(bot_usernames, progress=None, max_age=None, session_paths=None,
+                                            session_folder='sessions'):
+    if isinstance(bot_usernames, str):
+        bot_usernames = [bot_usernames]
+
+    if not os.path.exists(session_folder):
+        print(f"Error: '{session_folder}' folder not found.")
+        return {}
+
+    auth_dates = await asyncio.to_thread(get_query_auth_dates, bot_usernames) if max_age is not None else None
+
+    # Only new or changed session files are read, the others come from the registry.
+    # The database work runs off the loop, so API requests served from it keep going.
+    jobs = []
+    for row in await asyncio.to_thread(scan_sessions, session_folder):
+        if session_paths is not None and row['path'] not in session_paths:
+            continue  # Handled by another worker process
+        identity = session_identity(row)
+        bots = bot_usernames if max_age is None else stale_bots(identity, bot_usernames, auth_dates, max_age)
+        if not bots:
+            continue  # Every query of this session is still fresh
+        jobs.append((os.path.basename(row['path']), row['session_string'], identity, bots))
+
+    if max_age is not None:
+        print(f"{sum(len(job[3]) for job in jobs)} stale or missing queries to refresh")
+
+    if progress is not None:
+        progress.start(sum(len(job[3]) for job in jobs))
+
+    # Check every proxy concurrently up front, sessions are only assigned to healthy ones
+    await get_proxy_pool().check_all()
+
+    global_limit = asyncio.Semaphore(max_concurrency)
+
+    # return_exceptions keeps a failing session from cancelling the rest
+    outcomes = await asyncio.gather(*(
+        generate_queries_limited(session_file, session_string, bots, identity, global_limit, progress, max_age)
+        for session_file, session_string, identity, bots in jobs
+    ), return_exceptions=True)
+
+    # Collect the result of every session: {bot: query or exception}, or the exception the whole session failed with
+    results = {}
+    succeeded = failed = skipped = 0
+    for (session_file, _, _, bots), outcome in zip(jobs, outcomes):
+        results[session_file] = outcome
+        if isinstance(outcome, BaseException):
+            # Only a cancellation gets here, generate_queries_limited returns every other failure per bot
+            print(f"Session {session_file} failed: {outcome}")
+            failed += len(bots)
+            if progress is not None:
+                for bot_username in bots:
+                    progress.record(session_file, bot_username, error=outcome)
+            continue
+        for bot_username, result in outcome.items():
+            if isinstance(result, WorkLeased):
+                skipped += 1
+            elif isinstance(result, BaseException):
+                failed += 1
+            else:
+                succeeded += 1
+
+    await get_query_writer().flush()  # Make every generated row visible before returning
+    print(f"Bots {', '.join(bot_usernames)}: {succeeded} queries generated, {failed} failed, "
+          f"{skipped} left to other instances")
+    return results
+
+# Return the proxy pool, loading proxies.txt on first use
+def get_proxy_pool():
+    global proxy_pool
+    if proxy_pool is None:
+        proxy_pool = ProxyPool(load_proxies("proxies.txt"), max_concurrency_per_proxy)
+    return proxy_pool
+
+# Entry point of a --workers process: generate the queries of every count-th session starting at index,
+# with its own event loop and its own share of the proxies. The rows and the lease releases are returned
+# to the parent, which writes the rows to the shared database before it releases the leases.
+def run_worker(index: int, count: int, settings: dict):
+    global api_id, api_hash, max_concurrency, max_concurrency_per_proxy, proxy_pool
+
+    api_id = settings['api_id']
+    api_hash = settings['api_hash']
+    max_concurrency = settings['max_concurrency']
+    max_concurrency_per_proxy = settings['max_concurrency_per_proxy']
+
+    # The parent scanned the sessions folder, so the registry is up to date
+    paths = [row['path'] for row in get_registered_sessions()][index::count]
+    proxies = load_proxies("proxies.txt")
+    proxy_pool = ProxyPool(proxies[index::count], max_concurrency_per_proxy)  # Every proxy belongs to one worker
+
+    collector = collect_rows()
+    results = asyncio.run(generate_queries_for_all_sessions(settings['bot_usernames'], max_age=settings['max_age'],
+                                                            session_paths=set(paths)))
+
+    succeeded = failed = skipped = 0
+    errors = {}
+    for session_file, outcome in results.items():
+        outcomes = outcome.items() if isinstance(outcome, dict) else ((bot, outcome) for bot in settings['bot_usernames'])
+        for bot_username, result in outcomes:
+            if isinstance(result, WorkLeased):
+                skipped += 1  # Left to another instance sharing the database
+            elif isinstance(result, BaseException):
+                failed += 1
+                errors.setdefault(session_file, {})[bot_username] = str(result)
+            else:
+                succeeded += 1
+
+    return {'queries': collector.queries, 'sessions': collector.sessions, 'releases': collector.releases,
+            'sessions_processed': len(paths), 'succeeded': succeeded, 'failed': failed, 'skipped': skipped,
+            'errors': errors}
+
+# Split the sessions folder over a pool of worker processes and merge their rows into the database.
+# With max_age only the queries that are missing or older than max_age seconds are generated again.
+def run_sharded_refresh(bot_usernames, workers: int, max_age=None):
+    scan_sessions('sessions')  # Index the folder once, the workers only read the registry
+
+    # Each proxy is used by a single worker, so MAX_CONCURRENCY_PER_PROXY holds across the processes
+    proxies = load_proxies("proxies.txt")
+    if proxies and len(proxies) < workers:
+        print(f"Only {len(proxies)} proxies for {workers} workers, running {len(proxies)} workers")
+        workers = len(proxies)
+
+    settings = {
+        'api_id': api_id,
+        'api_hash': api_hash,
+        'max_concurrency': max_concurrency,
+        'max_concurrency_per_proxy': max_concurrency_per_proxy,
+        'bot_usernames': list(bot_usernames),
+        'max_age': max_age,
+    }
+    started = time.time()
+    sessions_processed = succeeded = failed = skipped = 0
+
+    # spawn gives every worker a clean interpreter without the parent's threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(run_worker, index, workers, settings) for index in range(workers)]
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Worker process failed: {e}")
+                continue
+            write_batch(result['queries'], result['sessions'])  # Merge the rows of this worker
+            for release in result['releases']:  # Its leases are only given up once the rows are in
+                try:
+                    release()
+                except Exception as e:
+                    print(f"Error while releasing a work lease: {e}")
+            sessions_processed += result['sessions_processed']
+            succeeded += result['succeeded']
+            failed += result['failed']
+            skipped += result['skipped']
+            for session_file, errors in result['errors'].items():
+                for bot_username, error in errors.items():
+                    print(f"Session {session_file} failed for bot {bot_username}: {error}")
+
+    print(f"{workers} workers processed {sessions_processed} sessions in {time.time() - started:.1f}s: "
+          f"{succeeded} queries generated, {failed} failed, {skipped} left to other instances")
+
+def load_proxies(file_path):
+    # Validate the existence of the file
+    if not os.path.exists(file_path):
+        print(f"Error: The file '{file_path}' does not exist.")
+        exit(1)
+
+    # Read the file and store proxies in a list
+    with open(file_path, 'r') as file:
+        proxies = [line.strip() for line in file if line.strip()]  # Strip whitespace and filter out empty lines
+
+    # Check if the file is empty
+    if not proxies:
+        print(f"Warning: The file '{file_path}' is empty.")
+    
+    return proxies
+
+# Read the settings from the .env file into the globals, exits on invalid settings
+def load_settings():
+    global api_id, api_hash, usernames, max_concurrency, max_concurrency_per_proxy, query_max_age
+
+    load_dotenv(find_dotenv())
+
+    api_id = os.getenv('API_ID')
+    api_hash = os.getenv('API_HASH')
+    usernames_str = os.getenv('BOT_USERNAMES')
+
+    if api_id is None or api_hash is None:
+        print("Error: API_ID and API_HASH must be set in the .env file.")
+        exit(1)
+
+    if api_id.strip() == "" or api_hash.strip() == "":
+        print("Error: API_ID and API_HASH cannot be empty.")
+        exit(1)
+
+    try:
+        api_id = int(api_id)
+    except ValueError:
+        print("Error: API_ID must be an integer.")
+        exit(1)
+
+    # Validate BOT_USERNAMES
+    if usernames_str is None:
+        print("Error: BOT_USERNAMES must be set in the .env file.")
+        exit(1)
+
+    usernames = [username.strip() for username in usernames_str.split(",") if username.strip()]
+
+    if not usernames:
+        print("Error: BOT_USERNAMES cannot be empty.")
+        exit(1)
+
+    # Optional concurrency limits, the defaults are used when they are not set
+    try:
+        max_concurrency = int(os.getenv('MAX_CONCURRENCY') or max_concurrency)
+        max_concurrency_per_proxy = int(os.getenv('MAX_CONCURRENCY_PER_PROXY') or max_concurrency_per_proxy)
+    except ValueError:
+        print("Error: MAX_CONCURRENCY and MAX_CONCURRENCY_PER_PROXY must be integers.")
+        exit(1)
+
+    try:
+        query_max_age = int(os.getenv('QUERY_MAX_AGE') or query_max_age)
+    except ValueError:
+        print("Error: QUERY_MAX_AGE must be an integer.")
+        exit(1)
+
+    if max_concurrency < 1 or max_concurrency_per_proxy < 1:
+        print("Error: MAX_CONCURRENCY and MAX_CONCURRENCY_PER_PROXY must be at least 1.")
+        exit(1)
+
@@ -0,0 +1,179 @@
+import asyncio
+from storage import write_batch
+from metrics import PHASE_SECONDS, DB_ROWS_WRITTEN
+from settings import env_number
+
+DEFAULT_BATCH_SIZE = 200  # Rows written in one transaction at most
+DEFAULT_FLUSH_INTERVAL = 0.5  # Seconds a row may wait before its batch is written
+DEFAULT_WRITE_RETRIES = 3  # Attempts at writing a batch, e.g. while another process holds the database lock
+
+# Marker put on the queue to ask the writer to write its buffer right away
+_FLUSH = object()
+
+# Single writer task that receives generated rows over a queue and writes them with executemany,
+# one transaction per batch instead of one connection and commit per row
+class QueryWriter:
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size or max(int(env_number('WRITE_BATCH_SIZE', DEFAULT_BATCH_SIZE)), 1)
+        self.flush_interval = flush_interval or env_number('WRITE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        self.retries = max(int(env_number('WRITE_RETRIES', DEFAULT_WRITE_RETRIES)), 1)
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.rows_written = 0
+        self.batches_written = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+        return self
+
+    # Queue a generated query, the row is written by the next batch
+    def put_query(self, user_id: int, bot_username: str, query: str, name: str, proxy: str):
+        self.queue.put_nowait(('query', (user_id, bot_username, query, name, proxy)))
+
+    # Queue the identity of the account behind a session
+    def put_session(self, user_id: int, name: str, username: str, session: str):
+        self.queue.put_nowait(('session', (user_id, name, username, session)))
+
+    # Queue a blocking callback that runs once every row queued before it is committed, e.g. releasing a work lease
+    def put_release(self, release):
+        self.queue.put_nowait(('release', release))
+
+    # Write everything queued so far and wait until it is committed.
+    # Raises the error of a batch that could not be written since the last flush, its rows are lost.
+    async def flush(self):
+        done = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((_FLUSH, done))
+        await done
+
+    # Final flush, then stop the writer task
+    async def close(self):
+        if self.task is None:
+            return
+        try:
+            await self.flush()
+        finally:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # Write one batch, retrying with a growing delay. Returns the error when every attempt failed.
+    async def _write(self, buffer):
+        queries = [row for kind, row in buffer if kind == 'query']
+        sessions = [row for kind, row in buffer if kind == 'session']
+        releases = [row for kind, row in buffer if kind == 'release']
+        error = None
+        for attempt in range(self.retries if queries or sessions else 0):
+            try:
+                # The write is blocking, keep it off the event loop
+                with PHASE_SECONDS.time(phase='db_insert'):
+                    await asyncio.to_thread(write_batch, queries, sessions)
+            except Exception as e:
+                error = e
+                print(f"Error while writing {len(queries) + len(sessions)} rows to the database "
+                      f"(attempt {attempt + 1} of {self.retries}): {e}")
+                if attempt + 1 < self.retries:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+            error = None
+            self.rows_written += len(queries) + len(sessions)
+            DB_ROWS_WRITTEN.inc(len(queries) + len(sessions))
+            self.batches_written += 1
+            break
+        # The leases are released even when the rows are lost, so another instance may generate them again
+        for release in releases:
+            try:
+                await asyncio.to_thread(release)
+            except Exception as e:
+                print(f"Error while releasing a work lease: {e}")
+        return error
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        buffer = []
+        waiters = []
+        deadline = None
+        error = None  # Last failed batch since the waiters were answered
+
+        while True:
+            timeout = None if deadline is None else max(0, deadline - loop.time())
+            try:
+                kind, row = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                kind = row = None
+
+            if kind is _FLUSH:
+                waiters.append(row)
+            elif kind is not None:
+                buffer.append((kind, row))
+                if deadline is None:
+                    deadline = loop.time() + self.flush_interval
+
+            # Write on size, on time, or when someone is waiting for a flush
+            if buffer and (len(buffer) >= self.batch_size or waiters or loop.time() >= deadline):
+                error = await self._write(buffer) or error
+                buffer = []
+                deadline = None
+
+            if waiters and not buffer:
+                for waiter in waiters:
+                    if not waiter.done():
+                        if error is not None:
+                            waiter.set_exception(error)
+                        else:
+                            waiter.set_result(None)
+                waiters = []
+                error = None
+
+# Keeps the rows in memory instead of writing them, used by the --workers processes,
+# which hand their rows to the parent process that writes them to the shared database
+class RowCollector:
+    def __init__(self):
+        self.queries = []
+        self.sessions = []
+        self.releases = []  # Run by the parent once it wrote the rows
+
+    def put_query(self, user_id: int, bot_username: str, query: str, name: str, proxy: str):
+        self.queries.append((user_id, bot_username, query, name, proxy))
+
+    def put_session(self, user_id: int, name: str, username: str, session: str):
+        self.sessions.append((user_id, name, username, session))
+
+    def put_release(self, release):
+        self.releases.append(release)
+
+    # Nothing is written here, so there is nothing to wait for
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+# One writer per event loop
+_writers = {}
+_collector = None
+
+# Collect every row of this process in memory from now on, instead of writing it
+def collect_rows():
+    global _collector
+    _collector = RowCollector()
+    return _collector
+
+# Return the writer of the running event loop, starting it on first use
+def get_query_writer():
+    if _collector is not None:
+        return _collector
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = QueryWriter().start()
+    return writer
+
+# Flush and stop the writer of the running event loop
+async def close_query_writer():
+    writer = _writers.pop(asyncio.get_running_loop(), None)
+    if writer is not None:
+        await writer.close()
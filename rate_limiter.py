@@ -0,0 +1,70 @@
+import time
+import random
+import asyncio
+from settings import env_number
+
+DEFAULT_ACCOUNT_RATE = 0  # Requests per minute per account at most, 0 leaves the spacing to the FloodWaits
+DEFAULT_MAX_RETRIES = 3  # FloodWaits tolerated per (session, bot) before giving up
+DEFAULT_PARK_AFTER = 5  # Flood waits longer than this many seconds park the work item instead of sleeping inline
+
+# Raised for a (session, bot) that has to wait for a flood deadline before it can be retried
+class FloodParked(Exception):
+    def __init__(self, bot_username: str, wait: float):
+        super().__init__(f"Bot {bot_username} is parked for {wait:.0f} seconds after a FloodWait")
+        self.bot_username = bot_username
+        self.wait = wait
+
+# Central rate-limit state shared by every session on the event loop.
+# It tracks flood-wait deadlines per session (the whole account) and per (session, bot),
+# the number of FloodWaits per (session, bot), and spaces the requests of each account.
+class RateLimiter:
+    def __init__(self):
+        self.rate = env_number('ACCOUNT_RATE_LIMIT', DEFAULT_ACCOUNT_RATE)
+        self.min_interval = 60 / self.rate if self.rate > 0 else 0
+        self.max_retries = int(env_number('FLOOD_MAX_RETRIES', DEFAULT_MAX_RETRIES))
+        self.park_after = env_number('FLOOD_PARK_AFTER', DEFAULT_PARK_AFTER)
+        self.session_deadlines = {}  # {session: monotonic time}
+        self.bot_deadlines = {}  # {(session, bot): monotonic time}
+        self.flood_counts = {}  # {(session, bot): FloodWaits so far}
+        self.last_request = {}  # {session: monotonic time of the last request}
+
+    # Seconds until the flood deadlines of a session and bot have passed
+    def flood_wait(self, session: str, bot_username: str) -> float:
+        now = time.monotonic()
+        deadline = max(self.session_deadlines.get(session, 0), self.bot_deadlines.get((session, bot_username), 0))
+        return max(deadline - now, 0)
+
+    # Record a FloodWait. Returns False once the (session, bot) ran out of retries, the count starts
+    # over then, so the next refresh gets its own retries once the deadline passed.
+    def record_flood(self, session: str, bot_username: str, seconds: int, account_wide: bool = False) -> bool:
+        deadline = time.monotonic() + seconds + random.uniform(10, 30)  # Add a small random jitter to avoid precise retry timings
+        if account_wide:
+            self.session_deadlines[session] = max(self.session_deadlines.get(session, 0), deadline)
+        else:
+            self.bot_deadlines[(session, bot_username)] = max(self.bot_deadlines.get((session, bot_username), 0), deadline)
+        key = (session, bot_username)
+        self.flood_counts[key] = self.flood_counts.get(key, 0) + 1
+        if self.flood_counts[key] > self.max_retries:
+            del self.flood_counts[key]
+            return False
+        return True
+
+    def record_success(self, session: str, bot_username: str):
+        self.flood_counts.pop((session, bot_username), None)
+        self.bot_deadlines.pop((session, bot_username), None)
+
+    # Wait for the per-account request rate cap, then claim the next request slot of the session
+    async def acquire(self, session: str):
+        now = time.monotonic()
+        next_slot = max(self.last_request.get(session, 0) + self.min_interval, now)
+        self.last_request[session] = next_slot
+        if next_slot > now:
+            await asyncio.sleep(next_slot - now)
+
+_limiter = None
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
@@ -0,0 +1,241 @@
+import time
+import uuid
+import asyncio
+import threading
+from work_leases import WorkLeased
+from storage import save_refresh_job, get_saved_refresh_job, get_refresh_job_events
+
+MAX_FINISHED_JOBS = 50  # Finished jobs kept around for their status endpoint
+SAVE_INTERVAL = 0.5  # Seconds between saves of a running job to the database
+CHECK_INTERVAL = 1.0  # Seconds between database checks while waiting for events of a job of another process
+
+# A refresh running in the background. Progress is recorded from the event loop
+# and read from the Flask threads, so every access goes through the condition.
+# The job is saved to the database from its own thread, so the other processes serving
+# the API from the same database (asgi.py --workers) answer for it too, see StoredJob.
+class RefreshJob:
+    def __init__(self, bot_usernames, max_age=None):
+        self.id = uuid.uuid4().hex
+        self.bot_usernames = list(bot_usernames)
+        self.max_age = max_age  # Only refresh queries older than this, None refreshes everything
+        self.status = 'pending'
+        self.total = None  # Known once the sessions were scanned
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0  # Claimed by another instance sharing the database, or just refreshed by it
+        self.errors = {}  # {session file: {bot: error}}
+        self.events = []  # Every completed row, in order, for the event stream
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cond = threading.Condition()
+        self._async_waiters = set()  # (loop, asyncio.Event) of the coroutines waiting for events right now
+        self._saved_events = 0  # Events already in the database
+        self._finished = threading.Event()  # Wakes the save thread for the final save
+
+    # Wake the coroutines waiting in wait_events, called with the condition held
+    def _wake(self):
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # The loop was closed in the meantime
+
+    def start(self, total: int):
+        with self._cond:
+            self.status = 'running'
+            self.total = total
+            self.started_at = time.time()
+            self._wake()
+
+    # Record one (session, bot) row, called as soon as it completes
+    def record(self, session_file: str, bot_username: str, user_id=None, query=None, error=None):
+        with self._cond:
+            event = {'seq': len(self.events), 'session': session_file, 'bot': bot_username, 'user_id': user_id}
+            if error is None:
+                self.done += 1
+                event.update(status='done', query=query)
+            elif isinstance(error, WorkLeased):
+                self.skipped += 1
+                event.update(status='skipped', reason=str(error))
+            else:
+                self.failed += 1
+                self.errors.setdefault(session_file, {})[bot_username] = str(error)
+                event.update(status='failed', error=str(error))
+            self.events.append(event)
+            self._wake()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.status = 'failed' if error is not None else 'finished'
+            self.error = str(error) if error is not None else None
+            self.finished_at = time.time()
+            self._wake()
+        self._finished.set()
+
+    @property
+    def is_finished(self):
+        return self.status in ('finished', 'failed')
+
+    # Write the state and the new events to the database, blocking
+    def save(self):
+        with self._cond:
+            state = self.to_dict()
+            events = self.events[self._saved_events:]
+            finished = self.is_finished
+        save_refresh_job(self.id, state, events, finished, MAX_FINISHED_JOBS)
+        self._saved_events += len(events)
+
+    # Save the job every SAVE_INTERVAL until it finished, on its own thread so the writes never block the loop
+    def _save_loop(self):
+        while True:
+            finished = self._finished.wait(SAVE_INTERVAL)
+            try:
+                self.save()
+            except Exception as e:
+                print(f"Could not save refresh job {self.id}: {e}")
+                continue
+            if finished:
+                return
+
+    def to_dict(self):
+        with self._cond:
+            completed = self.done + self.failed + self.skipped
+            pending = None if self.total is None else max(self.total - completed, 0)
+            eta = None
+            if self.status == 'running' and completed and pending is not None:
+                eta = round((time.time() - self.started_at) / completed * pending, 1)
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'bots': self.bot_usernames,
+                'max_age': self.max_age,
+                'total': self.total,
+                'done': self.done,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'pending': pending,
+                'errors': self.errors,
+                'error': self.error,
+                'eta_seconds': eta,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+    # Return the events after the given position and whether the job finished, without blocking
+    def events_after(self, position: int):
+        with self._cond:
+            return self.events[position:], self.is_finished
+
+    # Same from a coroutine: wait up to timeout seconds for events after the given position,
+    # woken by record and finish instead of polling
+    async def wait_events(self, position: int, timeout: float):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            if position < len(self.events) or self.is_finished:
+                return self.events[position:], self.is_finished
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+        return self.events_after(position)
+
+    # Yield the events after the given position, blocking until new ones arrive or the job finishes
+    def iter_events(self, start: int = 0, timeout: float = 15):
+        position = start
+        while True:
+            with self._cond:
+                if position >= len(self.events) and not self.is_finished:
+                    self._cond.wait(timeout)
+                new_events = self.events[position:]
+                finished = self.is_finished
+            for event in new_events:
+                yield event
+            position += len(new_events)
+            if not new_events:
+                if finished:
+                    return
+                yield None  # Nothing happened within the timeout, lets the caller send a keep-alive
+
+# Read-only view of a job saved by another process serving the API from the same database.
+# Every read goes to the database, waiting for events checks it every CHECK_INTERVAL.
+class StoredJob:
+    def __init__(self, state):
+        self.id = state['job_id']
+        self._state = state
+
+    @property
+    def is_finished(self):
+        return self._state['status'] in ('finished', 'failed')
+
+    def to_dict(self):
+        state = get_saved_refresh_job(self.id)
+        if state is not None:
+            self._state = state
+        return self._state
+
+    # The state is read first, the events saved with it or after it are all there then
+    def events_after(self, position: int):
+        self.to_dict()
+        return get_refresh_job_events(self.id, position), self.is_finished
+
+    async def wait_events(self, position: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            events, finished = await asyncio.to_thread(self.events_after, position)
+            remaining = deadline - time.monotonic()
+            if events or finished or remaining <= 0:
+                return events, finished
+            await asyncio.sleep(min(remaining, CHECK_INTERVAL))
+
+    def iter_events(self, start: int = 0, timeout: float = 15):
+        position = start
+        idle = 0
+        while True:
+            events, finished = self.events_after(position)
+            for event in events:
+                yield event
+            position += len(events)
+            if events:
+                idle = 0
+            elif finished:
+                return
+            else:
+                time.sleep(CHECK_INTERVAL)
+                idle += CHECK_INTERVAL
+                if idle >= timeout:
+                    idle = 0
+                    yield None  # Lets the caller send a keep-alive
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+# Create a job and save it right away, so its status is found by every process as soon as its id is returned.
+# Blocking, call it off the event loop.
+def create_job(bot_usernames, max_age=None):
+    job = RefreshJob(bot_usernames, max_age)
+    job.save()
+    threading.Thread(target=job._save_loop, name=f'job-{job.id[:8]}', daemon=True).start()
+    with _jobs_lock:
+        _jobs[job.id] = job
+        # Forget the oldest finished jobs
+        finished = [old for old in _jobs.values() if old.is_finished]
+        for old in sorted(finished, key=lambda old: old.created_at)[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del _jobs[old.id]
+    return job
+
+# Return the job of this process, or the saved job of another process, or None. Blocking for the latter.
+def get_job(job_id: str):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job
+    state = get_saved_refresh_job(job_id)
+    return StoredJob(state) if state is not None else None
@@ -0,0 +1,171 @@
+import time
+import random
+import asyncio
+from storage import get_query_auth_dates, save_process_state, get_process_states
+from session_registry import scan_sessions
+from rate_limiter import get_rate_limiter
+from work_leases import WorkLeased
+from settings import env_number
+
+DEFAULT_LEAD = 600  # Seconds before a query turns stale that it is refreshed
+DEFAULT_RATE = 30  # Sessions refreshed per minute at most
+DEFAULT_CONCURRENCY = 2  # Sessions refreshed at the same time at most
+DEFAULT_POLL_INTERVAL = 30  # Seconds between checks when nothing is due
+DEFAULT_BACKOFF = 60  # Seconds before a failed (session, bot) is tried again, doubled on every further failure
+DEFAULT_BACKOFF_MAX = 3600  # Seconds between attempts at most
+STATUS_SAVE_INTERVAL = 5  # Seconds between saves of the status for the other processes serving the API
+
+# Return the bots of a session whose query is missing or older than max_age seconds
+def stale_bots(identity, bot_usernames, auth_dates, max_age):
+    if identity is None:
+        return list(bot_usernames)  # Never generated for this session yet
+    cutoff = time.time() - max_age
+    stale = []
+    for bot_username in bot_usernames:
+        auth_date = auth_dates.get((identity[0], bot_username))
+        if auth_date is None or auth_date < cutoff:
+            stale.append(bot_username)
+    return stale
+
+# Keeps the queries warm: every (user_id, bot) row is regenerated on a rolling basis shortly
+# before it reaches max_age. Due sessions are started one by one, spaced evenly by the rate,
+# so Telegram sees a steady trickle instead of a burst every max_age seconds.
+# A (session, bot) that failed is left alone for a growing backoff, one waiting for a flood deadline until it passed.
+class RefreshScheduler:
+    def __init__(self, bot_usernames, max_age, refresh_session, session_folder='sessions'):
+        self.bot_usernames = list(bot_usernames)
+        self.max_age = max_age
+        self.refresh_session = refresh_session  # async refresh_session(registry row, bots, on_result)
+        self.session_folder = session_folder
+        self.lead = env_number('SCHEDULER_LEAD', DEFAULT_LEAD)
+        self.rate = env_number('SCHEDULER_RATE', DEFAULT_RATE)
+        self.concurrency = int(env_number('SCHEDULER_CONCURRENCY', DEFAULT_CONCURRENCY))
+        self.poll_interval = env_number('SCHEDULER_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+        self.backoff = env_number('SCHEDULER_BACKOFF', DEFAULT_BACKOFF)
+        self.backoff_max = env_number('SCHEDULER_BACKOFF_MAX', DEFAULT_BACKOFF_MAX)
+        self.backoffs = {}  # {(path, bot): (failures in a row, monotonic time of the next attempt)}
+        self.task = None
+        self.status_task = None
+        self.in_flight = set()  # Paths of the sessions being refreshed right now
+        self.refreshed = 0
+        self.failed = 0
+        self.skipped = 0  # Left to another instance sharing the database
+        self.last_due = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+            self.status_task = asyncio.ensure_future(self._save_status())
+        return self
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.status_task.cancel()
+            self.task = self.status_task = None
+
+    # Save the status every STATUS_SAVE_INTERVAL, the scheduler only runs in one of the processes serving the API
+    async def _save_status(self):
+        while True:
+            try:
+                await asyncio.to_thread(save_process_state, 'scheduler', self.to_dict())
+            except Exception as e:
+                print(f"Could not save the scheduler status: {e}")
+            await asyncio.sleep(STATUS_SAVE_INTERVAL)
+
+    # Sessions with rows that turn stale within the lead time, the oldest rows first.
+    # Sessions whose account was never identified are left to explicit refreshes.
+    def due_sessions(self):
+        auth_dates = get_query_auth_dates(self.bot_usernames)
+        refresh_age = max(self.max_age - self.lead, 0)
+        limiter = get_rate_limiter()
+        now = time.monotonic()
+        due = []
+        for row in scan_sessions(self.session_folder):
+            if row['user_id'] is None or row['path'] in self.in_flight:
+                continue
+            identity = (row['user_id'], row['name'], row['username'])
+            bots = [bot for bot in stale_bots(identity, self.bot_usernames, auth_dates, refresh_age)
+                    if self.backoffs.get((row['path'], bot), (0, 0))[1] <= now
+                    and limiter.flood_wait(row['session_string'], bot) <= 0]
+            if bots:
+                oldest = min(auth_dates.get((row['user_id'], bot)) or 0 for bot in bots)
+                due.append((oldest, row, bots))
+        due.sort(key=lambda item: item[0])
+        return [(row, bots) for _, row, bots in due]
+
+    # Double the wait before the next attempt at a (session, bot) on every failure in a row
+    def _record_failure(self, path: str, bot_username: str):
+        failures = self.backoffs.get((path, bot_username), (0, 0))[0] + 1
+        wait = min(self.backoff * 2 ** (failures - 1), self.backoff_max)
+        self.backoffs[(path, bot_username)] = (failures, time.monotonic() + wait * random.uniform(0.8, 1.2))
+
+    async def _refresh(self, row, bots, slots):
+        results = {}  # Every bot reported so far, kept when the session fails later on
+
+        def on_result(bot_username, user_id, query, error):
+            results[bot_username] = error if error is not None else query
+
+        try:
+            results.update(await self.refresh_session(row, bots, on_result))
+        except Exception as e:
+            # Only the bots not reported yet failed with the session, not e.g. the ones left to another instance
+            print(f"Scheduled refresh of {row['path']} failed: {e}")
+            for bot_username in bots:
+                results.setdefault(bot_username, e)
+        finally:
+            self.in_flight.discard(row['path'])
+            slots.release()
+
+        for bot_username, result in results.items():
+            if isinstance(result, WorkLeased):
+                self.skipped += 1
+            elif isinstance(result, BaseException):
+                self.failed += 1
+                self._record_failure(row['path'], bot_username)
+            else:
+                self.refreshed += 1
+                self.backoffs.pop((row['path'], bot_username), None)
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        spacing = 60 / self.rate if self.rate > 0 else self.poll_interval
+        print(f"Refresh scheduler started: max age {self.max_age}s, lead {self.lead}s, {self.rate} sessions/minute")
+
+        while True:
+            try:
+                due = await asyncio.to_thread(self.due_sessions)
+            except Exception as e:
+                print(f"Refresh scheduler could not plan the next refreshes: {e}")
+                due = []
+            self.last_due = len(due)
+
+            if not due:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            # Start the due sessions one by one, evenly spaced, then plan again
+            for row, bots in due:
+                await slots.acquire()
+                self.in_flight.add(row['path'])
+                asyncio.ensure_future(self._refresh(row, bots, slots))
+                await asyncio.sleep(spacing * random.uniform(0.8, 1.2))  # A little jitter keeps the load smooth
+
+    def to_dict(self):
+        return {
+            'running': self.task is not None and not self.task.done(),
+            'max_age': self.max_age,
+            'lead': self.lead,
+            'rate_per_minute': self.rate,
+            'concurrency': self.concurrency,
+            'due': self.last_due,
+            'in_flight': len(self.in_flight),
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'backing_off': sum(1 for _, next_attempt in self.backoffs.values() if next_attempt > time.monotonic()),
+        }
+
+# Status saved by the scheduler of another process sharing the database, None when none saved one lately
+def get_saved_status():
+    return get_process_states('scheduler', 3 * STATUS_SAVE_INTERVAL).get('scheduler')
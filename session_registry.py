@@ -0,0 +1,33 @@
+import os
+from storage import get_registered_sessions, register_session, remove_sessions
+
+# Index the session files of a folder in the sessions table.
+# Only new files and files whose mtime changed are read again, the others come from the table
+# together with the cached identity (user_id, name, username) of their account.
+def scan_sessions(session_folder: str = 'sessions'):
+    known = {row['path']: row for row in get_registered_sessions()}
+    seen = set()
+
+    for entry in sorted(os.scandir(session_folder), key=lambda entry: entry.name):
+        if not entry.name.endswith('.session') or not entry.is_file():
+            continue
+
+        path = entry.path
+        seen.add(path)
+        mtime = entry.stat().st_mtime
+        row = known.get(path)
+        if row is not None and row['mtime'] == mtime:
+            continue  # Unchanged since the last scan
+
+        with open(path, 'r') as file:
+            session_string = file.read().strip()
+
+        # The cached identity only stays valid when the session itself didn't change
+        register_session(path, mtime, session_string, keep_identity=row is not None and row['session_string'] == session_string)
+
+    # Forget the files that were removed from the folder
+    removed = [path for path in known if path not in seen and os.path.dirname(path) == session_folder]
+    if removed:
+        remove_sessions(removed)
+
+    return [row for row in get_registered_sessions() if row['path'] in seen]
@@ -0,0 +1,11 @@
+import os
+
+# Read a numeric setting from the environment. An unset or empty variable gives the default,
+# an invalid one prints a warning and gives the default too, so a typo never stops the app.
+def env_number(name, default):
+    value = os.getenv(name)
+    try:
+        return float(value) if value else default
+    except ValueError:
+        print(f"Warning: {name} must be a number, using {default}.")
+        return default
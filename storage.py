@@ -0,0 +1,447 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from urllib.parse import parse_qs
+from settings import env_number
+
+# Every table lives in one SQLite database in WAL mode, so the API can read while a refresh writes
+DEFAULT_DATABASE_PATH = 'query_id.db'
+DEFAULT_CHANGE_LOG_SIZE = 100000  # Change log entries kept, consumers further behind have to reload everything
+
+# One connection per thread, reused by every helper instead of connecting for each statement
+_local = threading.local()
+
+def get_database_path():
+    return os.getenv('DATABASE_PATH') or DEFAULT_DATABASE_PATH
+
+# Return the connection of the current thread, opening it on first use
+def get_connection():
+    path = get_database_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != path:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row  # To return rows as dictionaries
+        conn.execute('PRAGMA journal_mode=WAL')  # Readers don't block the writer and the other way around
+        conn.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL, avoids an fsync per commit
+        conn.execute('PRAGMA busy_timeout=30000')
+        _local.conn = conn
+        _local.path = path
+    return conn
+
+# Version of the schema created by init_db, stored in PRAGMA user_version
+SCHEMA_VERSION = 1
+
+def _columns(db, table: str):
+    return {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+
+# Bring a database written by an older version up to SCHEMA_VERSION, keeping its rows
+def _migrate(db, version: int):
+    if version < 1:
+        # The parsed tgWebAppData columns were added to queries, fill them in for the existing rows
+        for column, column_type in (('auth_date', 'INTEGER'), ('tg_user', 'TEXT'), ('hash', 'TEXT')):
+            if column not in _columns(db, 'queries'):
+                db.execute(f'ALTER TABLE queries ADD COLUMN {column} {column_type}')
+        rows = db.execute('SELECT rowid, query FROM queries WHERE auth_date IS NULL').fetchall()
+        db.executemany('UPDATE queries SET auth_date = ?, tg_user = ?, hash = ? WHERE rowid = ?',
+                       [(*parse_web_app_data(row['query']), row['rowid']) for row in rows])
+
+        db.execute('DROP TABLE IF EXISTS queries_for_sessions')  # Replaced by the sessions registry
+
+    db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+# Create the missing tables and indexes and migrate the existing ones.
+# Every table is kept across runs, so a restart serves the rows of the last run right away.
+def init_db():
+    with get_connection() as db:
+        db.execute('''CREATE TABLE IF NOT EXISTS queries (
+            user_id INTEGER NOT NULL,
+            bot_username TEXT NOT NULL,
+            query TEXT NOT NULL,
+            name TEXT NOT NULL,
+            proxy TEXT,
+            auth_date INTEGER,
+            tg_user TEXT,
+            hash TEXT
+        )''')
+
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            print(f"Migrating the database from schema version {version} to {SCHEMA_VERSION}")
+            _migrate(db, version)
+
+        db.execute('CREATE INDEX IF NOT EXISTS idx_queries_user_bot ON queries (user_id, bot_username)')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_queries_bot ON queries (bot_username)')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_queries_auth_date ON queries (auth_date)')
+
+        # Registry of the session files with the cached identity of their account, kept across runs
+        db.execute('''CREATE TABLE IF NOT EXISTS sessions (
+            path TEXT NOT NULL PRIMARY KEY,
+            mtime REAL NOT NULL,
+            session_string TEXT NOT NULL,
+            user_id INTEGER,
+            name TEXT,
+            username TEXT
+        )''')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_sessions_session ON sessions (session_string)')
+
+        # Sticky proxy of every session, kept across runs
+        db.execute('''CREATE TABLE IF NOT EXISTS proxies (
+            session_string TEXT NOT NULL PRIMARY KEY,
+            proxy TEXT
+        )''')
+
+        # Counters such as the version of the queries table, bumped on every change to it
+        db.execute('''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT NOT NULL PRIMARY KEY,
+            value INTEGER NOT NULL
+        )''')
+        db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('queries_version', 0)")
+
+        # Resolved bot peers of every account, kept across runs so bots are only resolved once
+        db.execute('''CREATE TABLE IF NOT EXISTS bot_peers (
+            user_id INTEGER NOT NULL,
+            bot_username TEXT NOT NULL,
+            peer_id INTEGER NOT NULL,
+            access_hash INTEGER NOT NULL,
+            PRIMARY KEY (user_id, bot_username)
+        )''')
+
+        # Proxy health is a cache with its own TTL, it is kept across runs
+        db.execute('''CREATE TABLE IF NOT EXISTS proxy_health (
+            proxy TEXT NOT NULL PRIMARY KEY,
+            healthy INTEGER NOT NULL,
+            checked_at REAL NOT NULL,
+            error TEXT
+        )''')
+
+        # Change log of the queries table, one entry per inserted query and per deleted account, in seq order.
+        # 'upsert' carries the new row, which replaces the previous one of the same user_id and bot_username,
+        # 'delete' removes every row of its user_id, once the last session of the account was removed.
+        db.execute('''CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            user_id INTEGER,
+            bot_username TEXT,
+            query TEXT,
+            name TEXT,
+            proxy TEXT,
+            auth_date INTEGER,
+            tg_user TEXT,
+            hash TEXT,
+            changed_at REAL NOT NULL
+        )''')
+        db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('changes_pruned', 0)")
+
+        # Claims of the (session, bot) units being generated, so instances sharing this database never
+        # generate the same unit at the same time. A lease that is not renewed before expires_at is free again.
+        db.execute('''CREATE TABLE IF NOT EXISTS work_leases (
+            session_string TEXT NOT NULL,
+            bot_username TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (session_string, bot_username)
+        )''')
+        db.execute('CREATE INDEX IF NOT EXISTS idx_work_leases_owner ON work_leases (owner)')
+
+        # Refresh jobs and their events, so every process serving the API from this database can answer for them
+        db.execute('''CREATE TABLE IF NOT EXISTS refresh_jobs (
+            id TEXT NOT NULL PRIMARY KEY,
+            finished INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )''')
+        db.execute('''CREATE TABLE IF NOT EXISTS refresh_job_events (
+            job_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            PRIMARY KEY (job_id, seq)
+        )''')
+
+        # Status the processes serving the API share with each other, e.g. the scheduler status and metric values
+        db.execute('''CREATE TABLE IF NOT EXISTS process_state (
+            key TEXT NOT NULL PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )''')
+
+# Callbacks run after every committed change to the queries or sessions tables, e.g. to drop read caches
+_change_listeners = []
+
+def add_change_listener(callback):
+    _change_listeners.append(callback)
+
+def _notify_change():
+    for callback in _change_listeners:
+        callback()
+
+# Called inside the transaction of every write to the queries table
+def _bump_queries_version(db):
+    db.execute("UPDATE meta SET value = value + 1 WHERE key = 'queries_version'")
+
+# Version of the queries table, it changes whenever a query is inserted or deleted
+def get_queries_version():
+    db = get_connection()
+    row = db.execute("SELECT value FROM meta WHERE key = 'queries_version'").fetchone()
+    return row[0] if row else 0
+
+# Raised when the change log no longer holds the entries after a consumer's cursor
+class ChangesPruned(Exception):
+    pass
+
+# Return up to limit change log entries after seq since, oldest first
+def get_changes(since: int, limit: int = 1000):
+    db = get_connection()
+    pruned = db.execute("SELECT value FROM meta WHERE key = 'changes_pruned'").fetchone()
+    if pruned and since < pruned[0]:
+        raise ChangesPruned(f"Changes up to {pruned[0]} were pruned, reload every query and start from the latest seq")
+    return db.execute('SELECT * FROM changes WHERE seq > ? ORDER BY seq LIMIT ?', (since, limit)).fetchall()
+
+# Seq of the latest change log entry, the cursor to start following the changes from
+def get_latest_change_seq():
+    db = get_connection()
+    return db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+# Append an 'upsert' entry per inserted row to the change log
+def _log_upserts(db, rows):
+    now = time.time()
+    db.executemany('''INSERT INTO changes (op, user_id, bot_username, query, name, proxy, auth_date, tg_user, hash, changed_at)
+        VALUES ('upsert', ?, ?, ?, ?, ?, ?, ?, ?, ?)''', [row + (now,) for row in rows])
+    _prune_changes(db)
+
+# Append a 'delete' entry per account whose rows were deleted to the change log
+def _log_deletes(db, user_ids):
+    now = time.time()
+    db.executemany("INSERT INTO changes (op, user_id, changed_at) VALUES ('delete', ?, ?)",
+                   [(user_id, now) for user_id in user_ids])
+    _prune_changes(db)
+
+# Drop the change log entries beyond CHANGE_LOG_SIZE
+def _prune_changes(db):
+    size = int(env_number('CHANGE_LOG_SIZE', DEFAULT_CHANGE_LOG_SIZE))
+    last = db.execute('SELECT MAX(seq) FROM changes').fetchone()[0] or 0
+    if last > size:
+        db.execute('DELETE FROM changes WHERE seq <= ?', (last - size,))
+        db.execute("UPDATE meta SET value = MAX(value, ?) WHERE key = 'changes_pruned'", (last - size,))
+
+# Split a tgWebAppData query into (auth_date, user JSON, hash), missing fields are None
+def parse_web_app_data(query: str):
+    fields = parse_qs(query)
+    auth_date = fields.get('auth_date', [None])[0]
+    user = fields.get('user', [None])[0]
+    try:
+        auth_date = int(auth_date) if auth_date is not None else None
+    except ValueError:
+        auth_date = None
+    if user is not None:
+        try:
+            user = json.dumps(json.loads(user))  # Normalized JSON of the embedded user
+        except ValueError:
+            pass
+    return auth_date, user, fields.get('hash', [None])[0]
+
+_INSERT_QUERY = '''INSERT INTO queries (user_id, bot_username, query, name, proxy, auth_date, tg_user, hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+
+# The row of a query with its parsed columns
+def _query_row(user_id: int, bot_username: str, query: str, name: str, proxy: str):
+    return (user_id, bot_username, query, name, proxy) + parse_web_app_data(query)
+
+# Insert many queries and update many session identities in a single transaction
+def write_batch(queries, sessions):
+    with get_connection() as db:
+        if queries:
+            # A refreshed query replaces the previous one of the same user and bot
+            db.executemany('DELETE FROM queries WHERE user_id = ? AND bot_username = ?', [row[:2] for row in queries])
+            rows = [_query_row(*row) for row in queries]
+            db.executemany(_INSERT_QUERY, rows)
+            _log_upserts(db, rows)
+            _bump_queries_version(db)
+        if sessions:
+            db.executemany('UPDATE sessions SET user_id = ?, name = ?, username = ? WHERE session_string = ?', sessions)
+    _notify_change()
+
+def get_registered_sessions():
+    db = get_connection()
+    return db.execute('SELECT * FROM sessions ORDER BY path').fetchall()
+
+# Add or update a session file in the registry
+def register_session(path: str, mtime: float, session_string: str, keep_identity: bool = False):
+    with get_connection() as db:
+        if keep_identity:
+            db.execute('''INSERT INTO sessions (path, mtime, session_string) VALUES (?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime''', (path, mtime, session_string))
+        else:
+            db.execute('''INSERT INTO sessions (path, mtime, session_string) VALUES (?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, session_string = excluded.session_string,
+                user_id = NULL, name = NULL, username = NULL''', (path, mtime, session_string))
+    _notify_change()
+
+# Forget removed session files. The queries of the accounts left without a session are deleted with them,
+# nothing would refresh them anymore.
+def remove_sessions(paths):
+    with get_connection() as db:
+        placeholders = ', '.join('?' for _ in paths)
+        user_ids = [row[0] for row in db.execute(
+            f'SELECT DISTINCT user_id FROM sessions WHERE user_id IS NOT NULL AND path IN ({placeholders})', list(paths))]
+        db.executemany('DELETE FROM sessions WHERE path = ?', [(path,) for path in paths])
+        _delete_orphaned_queries(db, user_ids)
+    _notify_change()
+
+# Delete the queries of the given accounts that no registered session belongs to anymore
+def _delete_orphaned_queries(db, user_ids):
+    orphans = [user_id for user_id in user_ids
+               if db.execute('SELECT 1 FROM sessions WHERE user_id = ? LIMIT 1', (user_id,)).fetchone() is None]
+    if orphans:
+        db.executemany('DELETE FROM queries WHERE user_id = ?', [(user_id,) for user_id in orphans])
+        _log_deletes(db, orphans)
+        _bump_queries_version(db)
+
+# Return the registry row of the session of an account, or None
+def get_session_for_user(user_id):
+    db = get_connection()
+    return db.execute('SELECT * FROM sessions WHERE user_id = ? LIMIT 1', (user_id,)).fetchone()
+
+# Return the registry row of a session string, or None
+def get_session_by_string(session: str):
+    db = get_connection()
+    return db.execute('SELECT * FROM sessions WHERE session_string = ? LIMIT 1', (session,)).fetchone()
+
+# Fetch queries, optionally filtered by user ID and/or bot name
+def get_queries(user_id=None, bot_username=None):
+    db = get_connection()
+    if user_id and bot_username:
+        return db.execute('SELECT * FROM queries WHERE user_id = ? AND bot_username = ?', (user_id, bot_username)).fetchall()
+    if user_id:
+        return db.execute('SELECT * FROM queries WHERE user_id = ?', (user_id,)).fetchall()
+    if bot_username:
+        return db.execute('SELECT * FROM queries WHERE bot_username = ?', (bot_username,)).fetchall()
+    return db.execute('SELECT * FROM queries').fetchall()
+
+# Return {(user_id, bot_username): auth_date} of the stored queries of the given bots
+def get_query_auth_dates(bot_usernames):
+    db = get_connection()
+    placeholders = ', '.join('?' for _ in bot_usernames)
+    rows = db.execute(f'SELECT user_id, bot_username, auth_date FROM queries WHERE bot_username IN ({placeholders})',
+                      list(bot_usernames)).fetchall()
+    return {(row['user_id'], row['bot_username']): row['auth_date'] for row in rows}
+
+# Claim the bots of a session for owner until ttl seconds from now and return the bots it holds.
+# Free and expired leases are taken over, leases of other owners that are still valid are left alone.
+def claim_work(owner: str, session: str, bot_usernames, ttl: float):
+    now = time.time()
+    with get_connection() as db:
+        db.executemany('''INSERT INTO work_leases (session_string, bot_username, owner, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (session_string, bot_username) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE work_leases.owner = excluded.owner OR work_leases.expires_at < ?''',
+            [(session, bot_username, owner, now + ttl, now) for bot_username in bot_usernames])
+        placeholders = ', '.join('?' for _ in bot_usernames)
+        rows = db.execute(f'''SELECT bot_username FROM work_leases
+            WHERE session_string = ? AND owner = ? AND bot_username IN ({placeholders})''',
+            [session, owner, *bot_usernames]).fetchall()
+    held = {row['bot_username'] for row in rows}
+    return [bot_username for bot_username in bot_usernames if bot_username in held]
+
+# Heartbeat: extend every lease of owner, returns the number of leases it still holds
+def renew_work(owner: str, ttl: float):
+    with get_connection() as db:
+        return db.execute('UPDATE work_leases SET expires_at = ? WHERE owner = ?', (time.time() + ttl, owner)).rowcount
+
+# Give up the leases of owner on the given bots of a session, or on everything when session is None
+def release_work(owner: str, session: str = None, bot_usernames=()):
+    with get_connection() as db:
+        if session is None:
+            db.execute('DELETE FROM work_leases WHERE owner = ?', (owner,))
+        else:
+            db.executemany('DELETE FROM work_leases WHERE session_string = ? AND bot_username = ? AND owner = ?',
+                           [(session, bot_username, owner) for bot_username in bot_usernames])
+
+# Return the proxy assigned to a session, or None when it has none
+def get_proxy_assignment(session: str):
+    db = get_connection()
+    row = db.execute('SELECT proxy FROM proxies WHERE session_string = ?', (session,)).fetchone()
+    return row[0] if row else None
+
+def save_proxy_assignment(session: str, proxy: str):
+    with get_connection() as db:
+        db.execute('INSERT OR REPLACE INTO proxies (session_string, proxy) VALUES (?, ?)', (session, proxy))
+
+def delete_proxy_assignment(session: str):
+    with get_connection() as db:
+        db.execute('DELETE FROM proxies WHERE session_string = ?', (session,))
+
+def save_proxy_status(proxy_str: str, healthy: bool, error: str = None):
+    with get_connection() as db:
+        db.execute('INSERT OR REPLACE INTO proxy_health (proxy, healthy, checked_at, error) VALUES (?, ?, ?, ?)',
+                   (proxy_str, int(healthy), time.time(), error))
+
+# Return (healthy, checked_at) of a proxy, or None when it was never checked
+def get_proxy_status(proxy_str: str):
+    db = get_connection()
+    row = db.execute('SELECT healthy, checked_at FROM proxy_health WHERE proxy = ?', (proxy_str,)).fetchone()
+    if row is None:
+        return None
+    return bool(row['healthy']), row['checked_at']
+
+# Return (peer_id, access_hash) of a bot resolved by an account, or None when it was never resolved
+def get_bot_peer(user_id: int, bot_username: str):
+    db = get_connection()
+    row = db.execute('SELECT peer_id, access_hash FROM bot_peers WHERE user_id = ? AND bot_username = ?',
+                     (user_id, bot_username.lower())).fetchone()
+    if row is None:
+        return None
+    return row['peer_id'], row['access_hash']
+
+def save_bot_peer(user_id: int, bot_username: str, peer_id: int, access_hash: int):
+    with get_connection() as db:
+        db.execute('INSERT OR REPLACE INTO bot_peers (user_id, bot_username, peer_id, access_hash) VALUES (?, ?, ?, ?)',
+                   (user_id, bot_username.lower(), peer_id, access_hash))
+
+def delete_bot_peer(user_id: int, bot_username: str):
+    with get_connection() as db:
+        db.execute('DELETE FROM bot_peers WHERE user_id = ? AND bot_username = ?', (user_id, bot_username.lower()))
+
+# Save the state of a refresh job and its new events, then forget the oldest finished jobs beyond keep
+def save_refresh_job(job_id: str, state: dict, events, finished: bool, keep: int):
+    with get_connection() as db:
+        db.execute('INSERT OR REPLACE INTO refresh_jobs (id, finished, state, created_at) VALUES (?, ?, ?, ?)',
+                   (job_id, int(finished), json.dumps(state), state['created_at']))
+        db.executemany('INSERT OR REPLACE INTO refresh_job_events (job_id, seq, event) VALUES (?, ?, ?)',
+                       [(job_id, event['seq'], json.dumps(event)) for event in events])
+        if finished:
+            old = [(row[0],) for row in db.execute(
+                'SELECT id FROM refresh_jobs WHERE finished = 1 ORDER BY created_at DESC LIMIT -1 OFFSET ?', (keep,))]
+            db.executemany('DELETE FROM refresh_job_events WHERE job_id = ?', old)
+            db.executemany('DELETE FROM refresh_jobs WHERE id = ?', old)
+
+# Return the saved state of a refresh job, or None when it is unknown
+def get_saved_refresh_job(job_id: str):
+    db = get_connection()
+    row = db.execute('SELECT state FROM refresh_jobs WHERE id = ?', (job_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+# Return the saved events of a refresh job from the given position on, in order
+def get_refresh_job_events(job_id: str, position: int = 0):
+    db = get_connection()
+    rows = db.execute('SELECT event FROM refresh_job_events WHERE job_id = ? AND seq >= ? ORDER BY seq', (job_id, position))
+    return [json.loads(row[0]) for row in rows]
+
+def save_process_state(key: str, state):
+    with get_connection() as db:
+        db.execute('INSERT OR REPLACE INTO process_state (key, state, updated_at) VALUES (?, ?, ?)',
+                   (key, json.dumps(state), time.time()))
+
+# Return {key: state} of the states under a key prefix that were saved within max_age seconds
+def get_process_states(prefix: str, max_age: float):
+    db = get_connection()
+    rows = db.execute('SELECT key, state FROM process_state WHERE substr(key, 1, ?) = ? AND updated_at >= ?',
+                      (len(prefix), prefix, time.time() - max_age))
+    return {row['key']: json.loads(row['state']) for row in rows}
+
+# Forget the states under a key prefix nobody saved within max_age seconds, e.g. of processes that are gone
+def prune_process_states(prefix: str, max_age: float):
+    with get_connection() as db:
+        db.execute('DELETE FROM process_state WHERE substr(key, 1, ?) = ? AND updated_at < ?',
+                   (len(prefix), prefix, time.time() - max_age))
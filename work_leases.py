@@ -0,0 +1,83 @@
+import os
+import uuid
+import socket
+import asyncio
+from functools import partial
+from storage import claim_work, renew_work, release_work
+from settings import env_number
+
+DEFAULT_LEASE_TTL = 120  # Seconds a claim stays valid without a heartbeat
+
+# Raised for a (session, bot) that another instance is generating right now, or just generated
+class WorkLeased(Exception):
+    def __init__(self, bot_username: str, done: bool = False):
+        state = "was just generated" if done else "is being generated"
+        super().__init__(f"Bot {bot_username} of this session {state} by another instance")
+        self.bot_username = bot_username
+
+# Claims of this instance in the work_leases table. Every (session, bot) is claimed before it is
+# generated and released afterwards, a heartbeat keeps the claims alive while the work is running.
+# Claims of an instance that crashed expire after the TTL and are taken over by the others.
+class LeaseManager:
+    def __init__(self, owner=None, ttl=None):
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.ttl = ttl or env_number('WORK_LEASE_TTL', DEFAULT_LEASE_TTL)
+        self.held = 0  # Leases held right now
+        self.task = None
+
+    # Claim the bots of a session, returns the ones this instance may generate
+    async def claim(self, session: str, bot_usernames):
+        self._start_heartbeat()
+        claimed = await asyncio.to_thread(claim_work, self.owner, session, list(bot_usernames), self.ttl)
+        self.held += len(claimed)
+        return claimed
+
+    # Release the claims once the rows queued on the writer so far are committed, so another instance
+    # that claims the bots next already sees the new queries. The release is picklable, so the
+    # --workers processes can hand it to the parent together with their rows.
+    def release_after_write(self, writer, session: str, bot_usernames):
+        bot_usernames = list(bot_usernames)
+        if bot_usernames:
+            self.held = max(self.held - len(bot_usernames), 0)
+            writer.put_release(partial(release_work, self.owner, session, bot_usernames))
+
+    async def release(self, session: str, bot_usernames):
+        bot_usernames = list(bot_usernames)
+        if bot_usernames:
+            await asyncio.to_thread(release_work, self.owner, session, bot_usernames)
+            self.held = max(self.held - len(bot_usernames), 0)
+
+    # Give up every claim of this instance, e.g. on shutdown
+    def release_all(self):
+        self.stop()
+        release_work(self.owner)
+        self.held = 0
+
+    def _start_heartbeat(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self._heartbeat())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.get_loop().call_soon_threadsafe(self.task.cancel)  # Also called from outside the loop
+            self.task = None
+
+    # Renew the claims well before they expire, a third of the TTL leaves room for two missed beats
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if not self.held:
+                continue
+            try:
+                await asyncio.to_thread(renew_work, self.owner, self.ttl)
+            except Exception as e:
+                print(f"Could not renew the work leases: {e}")
+
+_manager = None
+
+def get_lease_manager():
+    global _manager
+    if _manager is None:
+        _manager = LeaseManager()
+    return _manager